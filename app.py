@@ -3,103 +3,1479 @@ SoundWave Backend - Deezer API for search + YouTube IFrame for playback
 No API keys needed. Free forever.
 """
 
-from flask import Flask, jsonify, request, send_file, redirect
+from flask import Flask, Response, g, jsonify, request, send_file, redirect
+from flask.json.provider import DefaultJSONProvider
 from flask_cors import CORS
-import subprocess, json, os, sys, re
+import subprocess, json, os, sys, re, time, threading, unicodedata, sqlite3, glob, uuid, shutil, heapq, itertools
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FuturesTimeout, wait, as_completed
 from pathlib import Path
-import urllib.request, urllib.parse
+import urllib.parse, http.client, queue, contextvars, shlex, importlib.util, asyncio
+from cpus import available_cpus
 
 app = Flask(__name__)
-CORS(app)
+CORS(app, expose_headers=["Accept-Ranges","Content-Range","Content-Length","ETag","Server-Timing","X-Request-ID"])
 
-CACHE_DIR = Path("./audio_cache")
+CACHE_DIR = Path("./audio_cache").absolute()  # send_file resolves relative paths against the app root, not the cwd
 CACHE_DIR.mkdir(exist_ok=True)
-search_cache = {}
+
+# ── Metrics ──
+# A minimal Prometheus registry: counters and histograms are updated in place, gauges are read
+# from the live objects at scrape time. Values are per process, so with several gunicorn workers
+# each scrape reports the worker that answered it.
+LATENCY_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+def _labels(labels):
+    esc = lambda v: str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+    return "{" + ",".join(f'{k}="{esc(v)}"' for k, v in labels) + "}" if labels else ""
+
+class Counter:
+    def __init__(self, name, help):
+        self.name, self.help, self._values, self._lock = name, help, {}, threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock: self._values[key] = self._values.get(key, 0) + amount
+
+    def snapshot(self):
+        with self._lock: return dict(self._values)
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help}\n# TYPE {self.name} counter"
+        for key, v in self.snapshot().items(): yield f"{self.name}{_labels(key)} {v}"
+
+class Histogram:
+    def __init__(self, name, help, buckets=LATENCY_BUCKETS):
+        self.name, self.help, self.buckets = name, help, buckets
+        self._values, self._lock = {}, threading.Lock()   # labels -> [bucket counts..., sum, count]
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            row = self._values.setdefault(key, [0]*(len(self.buckets)+2))
+            for i, b in enumerate(self.buckets):
+                if value <= b: row[i] += 1
+            row[-2] += value; row[-1] += 1
+
+    def render(self):
+        with self._lock: values = [(k, list(v)) for k, v in self._values.items()]
+        yield f"# HELP {self.name} {self.help}\n# TYPE {self.name} histogram"
+        for key, row in values:
+            for b, n in zip(self.buckets, row): yield f"{self.name}_bucket{_labels(key+(('le',b),))} {n}"
+            yield f"{self.name}_bucket{_labels(key+(('le','+Inf'),))} {row[-1]}"
+            yield f"{self.name}_sum{_labels(key)} {round(row[-2], 6)}\n{self.name}_count{_labels(key)} {row[-1]}"
+
+class Gauge:
+    """fn() returns {labels tuple: value}, or a plain number for an unlabelled gauge."""
+    def __init__(self, name, help, fn, type="gauge"):
+        self.name, self.help, self.fn, self.type = name, help, fn, type
+
+    def render(self):
+        try: values = self.fn()
+        except Exception as e: print(f"Metric {self.name} failed: {e}"); return
+        if not isinstance(values, dict): values = {(): values}
+        yield f"# HELP {self.name} {self.help}\n# TYPE {self.name} {self.type}"
+        for key, v in values.items():
+            if v is not None: yield f"{self.name}{_labels(key)} {v}"
+
+METRICS = []
+
+def metric(m):
+    METRICS.append(m); return m
+
+def render_metrics():
+    return "\n".join(line for m in METRICS for line in m.render()) + "\n"
+
+http_requests = metric(Counter("soundwave_http_requests_total", "HTTP requests by route, method and status."))
+http_latency = metric(Histogram("soundwave_http_request_duration_seconds", "Time to produce a response, by route."))
+http_inflight = Counter("soundwave_http_requests_in_flight", "Requests currently being handled.")
+metric(Gauge(http_inflight.name, http_inflight.help, lambda: http_inflight.snapshot().get((), 0)))
+deezer_requests = metric(Counter("soundwave_deezer_requests_total", "Deezer API calls by outcome (ok, error, timeout)."))
+deezer_latency = metric(Histogram("soundwave_deezer_request_duration_seconds", "Deezer API call latency."))
+ytdlp_runs = metric(Counter("soundwave_ytdlp_runs_total", "yt-dlp runs by operation and outcome (ok, error, timeout)."))
+ytdlp_latency = metric(Histogram("soundwave_ytdlp_duration_seconds", "yt-dlp run time by operation, excluding lane wait."))
+
+@app.before_request
+def _metrics_start():
+    g.metrics_t0 = time.perf_counter(); http_inflight.inc()
+
+@app.after_request
+def _metrics_record(response):
+    t0 = g.pop("metrics_t0", None)
+    if t0 is not None:
+        route = request.url_rule.rule if request.url_rule else "unmatched"
+        http_requests.inc(route=route, method=request.method, status=response.status_code)
+        http_latency.observe(time.perf_counter()-t0, route=route)
+        http_inflight.inc(-1)
+    return response
+
+# ── Tracing ──
+# Spans time the slow steps of a request (Deezer, JSON, yt-dlp, file serving) and are reported in a
+# Server-Timing header and, with TRACE_LOG, as one JSON line per request. When a request is not
+# traced, span() costs one context-variable lookup. TRACE=1 traces everything; otherwise a client
+# switches tracing on for a single request with an "X-Trace: 1" header.
+TRACE = os.environ.get("TRACE", "0") == "1"
+TRACE_HEADER = os.environ.get("TRACE_HEADER", "1") == "1"   # honour X-Trace: 1 from clients
+TRACE_LOG = os.environ.get("TRACE_LOG", "0") == "1"         # print a JSON trace line per traced request
+REQUEST_ID_RE = re.compile(r"[\w.:-]{1,128}")
+_trace = contextvars.ContextVar("trace", default=None)       # [(name, seconds)] while tracing
+
+class _Span:
+    __slots__ = ("spans", "name", "t0")
+    def __init__(self, spans, name): self.spans, self.name = spans, name
+    def __enter__(self): self.t0 = time.perf_counter()
+    def __exit__(self, *exc): self.spans.append((self.name, time.perf_counter()-self.t0))
+
+class _NoSpan:
+    __slots__ = ()
+    def __enter__(self): pass
+    def __exit__(self, *exc): pass
+
+_NO_SPAN = _NoSpan()
+
+def span(name):
+    """with span("deezer"): ... -- records the block's duration on the current request's trace."""
+    spans = _trace.get()
+    return _NO_SPAN if spans is None else _Span(spans, name)
+
+def submit_traced(pool, fn, *args):
+    """pool.submit(fn, *args) in a copy of the caller's context, so spans recorded by the work land
+    on the current request's trace (a pool thread otherwise runs in an empty context)."""
+    return pool.submit(contextvars.copy_context().run, fn, *args)
+
+def trace_wanted(headers):
+    return TRACE or (TRACE_HEADER and headers.get("X-Trace") == "1")
+
+def request_id(headers):
+    rid = headers.get("X-Request-ID", "")
+    return rid if REQUEST_ID_RE.fullmatch(rid) else uuid.uuid4().hex
+
+def server_timing(spans, total):
+    """Server-Timing value; repeated spans (e.g. several Deezer calls) are summed under one name."""
+    totals = {}
+    for name, s in spans: totals[name] = totals.get(name, 0) + s
+    return ", ".join(f"{n};dur={1000*s:.1f}" for n, s in [*totals.items(), ("total", total)])
+
+def trace_log(rid, method, path, status, spans, total):
+    print(json.dumps({"request_id":rid,"method":method,"path":path,"status":status,
+                      "total_ms":round(1000*total, 1),
+                      "spans":[{"name":n,"ms":round(1000*s, 1)} for n, s in spans]}), flush=True)
+
+@app.before_request
+def _trace_start():
+    g.request_id, g.trace_t0 = request_id(request.headers), time.perf_counter()
+    _trace.set([] if trace_wanted(request.headers) else None)
+
+@app.after_request
+def _trace_finish(response):
+    if "request_id" not in g: return response
+    response.headers["X-Request-ID"] = g.request_id
+    spans = _trace.get()
+    if spans is None: return response
+    _trace.set(None)
+    response.headers["Server-Timing"] = server_timing(spans, time.perf_counter()-g.trace_t0)
+    response.headers["Timing-Allow-Origin"] = "*"
+    if TRACE_LOG:  # logged once the body is sent, so the total includes file and stream transfer
+        rid, t0, method, path, status = g.request_id, g.trace_t0, request.method, request.path, response.status_code
+        response.call_on_close(lambda: trace_log(rid, method, path, status, spans, time.perf_counter()-t0))
+    return response
+
+# ── JSON ──
+# orjson, when installed, encodes and decodes API responses, Deezer payloads and cache entries
+# several times faster than the json module. Output keeps Flask's sorted keys and compact form;
+# the one difference is that non-ASCII text is sent as UTF-8 rather than as \u escapes.
+try: import orjson  # optional dependency
+except ImportError: orjson = None
+JSON_LIB = os.environ.get("JSON_LIB", "orjson" if orjson else "json")   # orjson | json
+USE_ORJSON = JSON_LIB == "orjson" and orjson is not None
+_ORJSON_OPTS = orjson.OPT_SORT_KEYS | orjson.OPT_NON_STR_KEYS if orjson else 0
+
+def json_loads(data):
+    return orjson.loads(data) if USE_ORJSON else json.loads(data)
+
+def json_dumps(obj):
+    """Compact JSON text for storage (cache values); key order is not significant here."""
+    return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS).decode() if USE_ORJSON else json.dumps(obj)
+
+class JSONProvider(DefaultJSONProvider):
+    def encode(self, obj):
+        """Compact, key-sorted response body bytes, without the trailing newline."""
+        with span("serialize"):
+            if USE_ORJSON: return orjson.dumps(obj, default=self.default, option=_ORJSON_OPTS)
+            return json.dumps(obj, default=self.default, ensure_ascii=self.ensure_ascii,
+                              sort_keys=self.sort_keys, separators=(",",":")).encode()
+
+    def dumps(self, obj, **kwargs):
+        if USE_ORJSON and not kwargs: return self.encode(obj).decode()
+        with span("serialize"): return super().dumps(obj, **kwargs)
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s) if USE_ORJSON and not kwargs else super().loads(s, **kwargs)
+
+    def response(self, *args, **kwargs):
+        if self.compact is False or (self.compact is None and self._app.debug):  # indented, as Flask does
+            return super().response(*args, **kwargs)
+        return json_response(self.encode(self._prepare_response_obj(args, kwargs)))
+
+app.json = JSONProvider(app)
+
+def json_response(body, status=200):
+    """Response for an already-encoded JSON body (e.g. one cached as bytes)."""
+    return app.response_class(body+b"\n", status=status, mimetype=app.json.mimetype)
+
+# ── Caches ──
+CACHE_BACKEND = os.environ.get("CACHE_BACKEND", "sqlite")                      # memory | sqlite | redis
+CACHE_DB = os.environ.get("CACHE_DB", str(CACHE_DIR/"cache.db"))
+REDIS_URL = os.environ.get("REDIS_URL", "redis://localhost:6379/0")
+SEARCH_CACHE_MAX = int(os.environ.get("SEARCH_CACHE_MAX", 2000))               # entries
+SEARCH_CACHE_BYTES = int(os.environ.get("SEARCH_CACHE_BYTES", 64*1024*1024))   # approx. JSON bytes, 0 = unlimited
+SEARCH_CACHE_TTL = float(os.environ.get("SEARCH_CACHE_TTL", 6*3600))           # seconds
+YTID_CACHE_MAX = int(os.environ.get("YTID_CACHE_MAX", 50000))
+YTID_CACHE_TTL = float(os.environ.get("YTID_CACHE_TTL", 7*86400))
+YTID_NEGATIVE_TTL = float(os.environ.get("YTID_NEGATIVE_TTL", 3600))             # for "Not found" results
+TRACK_CACHE_MAX = int(os.environ.get("TRACK_CACHE_MAX", 50000))
+TRACK_CACHE_TTL = float(os.environ.get("TRACK_CACHE_TTL", 86400))
+
+def normalize_query(q):
+    """Case-, whitespace- and unicode-insensitive form of a query, used for cache keys."""
+    return " ".join(unicodedata.normalize("NFKC", q).casefold().split())
+
+class TTLCache:
+    """Thread-safe LRU cache bounded by entry count and byte size (of the JSON form unless
+    sizeof says otherwise), with per-entry TTL."""
+    def __init__(self, max_entries=1000, max_bytes=0, ttl=3600, sizeof=None):
+        self.max_entries, self.max_bytes, self.ttl = max_entries, max_bytes, ttl
+        self.sizeof = sizeof or (lambda value: len(json_dumps(value)))
+        self._data = OrderedDict()  # key -> (expires_at, size, value), oldest first
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = self.misses = self.evictions = 0
+
+    def get(self, key):
+        with self._lock:
+            e = self._data.get(key)
+            if e is not None and e[0] < time.monotonic():
+                self._drop(key); e = None
+            if e is None: self.misses += 1; return None
+            self._data.move_to_end(key); self.hits += 1
+            return e[2]
+
+    def set(self, key, value, ttl=None):
+        size = self.sizeof(value)
+        if self.max_bytes and size > self.max_bytes: return
+        expires = time.monotonic() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            if key in self._data: self._drop(key)
+            self._data[key] = (expires, size, value)
+            self._bytes += size
+            while len(self._data) > self.max_entries or (self.max_bytes and self._bytes > self.max_bytes):
+                self._drop(next(iter(self._data))); self.evictions += 1
+
+    def _drop(self, key):
+        self._bytes -= self._data.pop(key)[1]
+
+    def stats(self):
+        with self._lock:
+            return {"backend":"memory","entries":len(self._data),"bytes":self._bytes,
+                    "hits":self.hits,"misses":self.misses,"evictions":self.evictions}
+
+def sqlite_conn(local, path):
+    """Autocommit WAL connection, one per thread and per process (connections must not cross a fork)."""
+    if getattr(local, "pid", None) != os.getpid():
+        db = sqlite3.connect(path, timeout=5, isolation_level=None)
+        db.execute("PRAGMA journal_mode=WAL"); db.execute("PRAGMA synchronous=NORMAL")
+        local.db, local.pid = db, os.getpid()
+    return local.db
+
+class SQLiteCache:
+    """On-disk LRU/TTL cache in a WAL-mode SQLite file, shared by all worker processes and restarts.
+    Entry and byte totals per namespace are kept in cache_totals, so a write only sweeps expired
+    entries and evicts when the namespace is over a limit (or every SWEEP_INTERVAL seconds)."""
+    SWEEP_INTERVAL = 300
+
+    def __init__(self, path, namespace, max_entries=1000, max_bytes=0, ttl=3600):
+        self.path, self.ns = path, namespace
+        self.max_entries, self.max_bytes, self.ttl = max_entries, max_bytes, ttl
+        self._local = threading.local()
+        self.hits = self.misses = self.evictions = 0
+        self._swept = time.time()
+        db = self._db()
+        with db:
+            db.execute("CREATE TABLE IF NOT EXISTS cache (ns TEXT, key TEXT, value TEXT, size INTEGER,"
+                       " expires REAL, accessed REAL, PRIMARY KEY (ns, key))")
+            db.execute("CREATE INDEX IF NOT EXISTS cache_lru ON cache (ns, accessed)")
+            db.execute("CREATE INDEX IF NOT EXISTS cache_expiry ON cache (ns, expires)")
+            db.execute("CREATE TABLE IF NOT EXISTS cache_totals (ns TEXT PRIMARY KEY, n INTEGER, size INTEGER)")
+            db.execute("INSERT OR IGNORE INTO cache_totals SELECT ?, COUNT(*), COALESCE(SUM(size),0) FROM cache WHERE ns=?",
+                       (self.ns,self.ns))
+
+    def _db(self): return sqlite_conn(self._local, self.path)
+
+    def get(self, key):
+        now = time.time()
+        try:
+            db = self._db()
+            row = db.execute("SELECT value FROM cache WHERE ns=? AND key=? AND expires>?", (self.ns,key,now)).fetchone()
+            if row: db.execute("UPDATE cache SET accessed=? WHERE ns=? AND key=?", (now,self.ns,key))
+        except sqlite3.Error as e:
+            print(f"Cache read failed: {e}"); row = None
+        if row is None: self.misses += 1; return None
+        self.hits += 1
+        return json_loads(row[0])
+
+    def _delete(self, db, where, params):
+        """Delete the matching rows of this namespace and take them off the totals; returns the count."""
+        n, size = db.execute(f"SELECT COUNT(*), COALESCE(SUM(size),0) FROM cache WHERE rowid IN ({where})", params).fetchone()
+        if n:
+            db.execute(f"DELETE FROM cache WHERE rowid IN ({where})", params)
+            db.execute("UPDATE cache_totals SET n=n-?, size=size-? WHERE ns=?", (n,size,self.ns))
+        return n
+
+    def set(self, key, value, ttl=None):
+        data = json_dumps(value)
+        if self.max_bytes and len(data) > self.max_bytes: return
+        now = time.time()
+        try:
+            db = self._db()
+            with db:
+                db.execute("BEGIN IMMEDIATE")
+                old = db.execute("SELECT size FROM cache WHERE ns=? AND key=?", (self.ns,key)).fetchone()
+                db.execute("INSERT OR REPLACE INTO cache VALUES (?,?,?,?,?,?)",
+                           (self.ns,key,data,len(data),now+(self.ttl if ttl is None else ttl),now))
+                db.execute("UPDATE cache_totals SET n=n+?, size=size+? WHERE ns=?",
+                           (0 if old else 1, len(data)-(old[0] if old else 0), self.ns))
+                n, size = db.execute("SELECT n, size FROM cache_totals WHERE ns=?", (self.ns,)).fetchone()
+                over_limit = n > self.max_entries or (self.max_bytes and size > self.max_bytes)
+                if not over_limit and now-self._swept < self.SWEEP_INTERVAL: return
+                self._swept = now
+                self._delete(db, "SELECT rowid FROM cache WHERE ns=? AND expires<=?", (self.ns,now))
+                n, size = db.execute("SELECT n, size FROM cache_totals WHERE ns=?", (self.ns,)).fetchone()
+                over = max(0, n-self.max_entries)
+                if self.max_bytes and size > self.max_bytes:
+                    # walk from the LRU end until enough bytes are freed
+                    i = 0
+                    for (s,) in db.execute("SELECT size FROM cache WHERE ns=? ORDER BY accessed", (self.ns,)):
+                        if size <= self.max_bytes: break
+                        size -= s; i += 1
+                    over = max(over, i)
+                if over:
+                    self.evictions += self._delete(db, "SELECT rowid FROM cache WHERE ns=? ORDER BY accessed LIMIT ?", (self.ns,over))
+        except sqlite3.Error as e:
+            print(f"Cache write failed: {e}")
+
+    def stats(self):
+        try: n, size = self._db().execute("SELECT n, size FROM cache_totals WHERE ns=?", (self.ns,)).fetchone()
+        except (sqlite3.Error, TypeError): n = size = None
+        return {"backend":"sqlite","entries":n,"bytes":size,
+                "hits":self.hits,"misses":self.misses,"evictions":self.evictions}
+
+class RedisCache:
+    """Cache on any Redis-protocol server (Redis, Valkey, KeyDB...). Size limits and eviction
+    are left to the server's maxmemory policy; entries expire via SETEX."""
+    def __init__(self, url, namespace, ttl=3600):
+        import redis  # optional dependency, only needed for CACHE_BACKEND=redis
+        self._errors = redis.RedisError
+        self.r = redis.Redis.from_url(url, socket_timeout=2, socket_connect_timeout=2)
+        self.prefix, self.ttl = f"soundwave:{namespace}:", ttl
+        self.hits = self.misses = 0
+
+    def get(self, key):
+        try: v = self.r.get(self.prefix+key)
+        except self._errors as e: print(f"Cache read failed: {e}"); v = None
+        if v is None: self.misses += 1; return None
+        self.hits += 1
+        return json_loads(v)
+
+    def set(self, key, value, ttl=None):
+        try: self.r.setex(self.prefix+key, max(1, int(self.ttl if ttl is None else ttl)), json_dumps(value))
+        except self._errors as e: print(f"Cache write failed: {e}")
+
+    def stats(self):
+        return {"backend":"redis","hits":self.hits,"misses":self.misses}
+
+def make_cache(namespace, max_entries, max_bytes, ttl):
+    """Build a cache on the configured CACHE_BACKEND, falling back to process memory."""
+    try:
+        if CACHE_BACKEND == "sqlite": return SQLiteCache(CACHE_DB, namespace, max_entries, max_bytes, ttl)
+        if CACHE_BACKEND == "redis": return RedisCache(REDIS_URL, namespace, ttl)
+    except Exception as e:
+        print(f"❌ {CACHE_BACKEND} cache unavailable ({e}), using memory")
+    return TTLCache(max_entries, max_bytes, ttl)
+
+search_cache = make_cache("search", SEARCH_CACHE_MAX, SEARCH_CACHE_BYTES, SEARCH_CACHE_TTL)
+yt_id_cache = make_cache("yt_id", YTID_CACHE_MAX, 0, YTID_CACHE_TTL)  # normalized yt_query -> video id, "" = not found
+track_cache = make_cache("track", TRACK_CACHE_MAX, 0, TRACK_CACHE_TTL)  # deezer_id -> song dict
+
+# ── Single-flight ──
+class SingleFlight:
+    """Collapses concurrent calls for the same key into one run; the others wait and share its result."""
+    class _Call:
+        def __init__(self): self.done, self.result, self.error = threading.Event(), None, None
+
+    def __init__(self):
+        self._lock, self._calls = threading.Lock(), {}
+
+    def do(self, key, fn):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader: call = self._calls[key] = self._Call()
+        if not leader:
+            call.done.wait()
+            if call.error: raise call.error
+            return call.result
+        try: call.result = fn()
+        except Exception as e: call.error = e; raise
+        finally:
+            with self._lock: del self._calls[key]
+            call.done.set()
+        return call.result
 
 # ── Find yt-dlp ──
-YTDLP_CMD = None
+# Candidates are probed with --version concurrently, off the import path, and working ones are kept
+# in CACHE_DIR/.ytdlp.json keyed on each candidate's binary path and mtime, so restarts and forked
+# workers skip the probe until yt-dlp is upgraded. YTDLP_DETECT: background (start with the
+# process's other background threads), lazy (start on first use) or eager (block import until done).
+YTDLP_DETECT = os.environ.get("YTDLP_DETECT", "background")
+YTDLP_DETECT_TIMEOUT = float(os.environ.get("YTDLP_DETECT_TIMEOUT", 10))  # per --version probe
+YTDLP_DETECT_CACHE = CACHE_DIR/".ytdlp.json"
+
+def ytdlp_candidates():
+    override = [shlex.split(os.environ["YTDLP_CMD"])] if os.environ.get("YTDLP_CMD") else []
+    return override+[[sys.executable,"-m","yt_dlp"],["yt-dlp"],["yt_dlp"]]
+
+def ytdlp_fingerprint(cmd):
+    """Binary path and mtime (plus the module file for "python -m"), or None if it is not installed."""
+    parts = []
+    for i, c in enumerate(cmd):
+        if i == 0: path = shutil.which(c)
+        elif cmd[i-1] == "-m":
+            try: spec = importlib.util.find_spec(c)
+            except (ImportError, ValueError): spec = None
+            path = spec and spec.origin
+        elif os.path.isfile(c): path = c
+        else: continue
+        if not path: return None
+        try: parts.append(f"{os.path.realpath(path)}@{os.stat(path).st_mtime_ns}")
+        except OSError: return None
+    return " ".join(cmd) + " | " + " ".join(parts)
+
+def probe_ytdlp(cmd):
+    try: return subprocess.run(cmd+["--version"],capture_output=True,text=True,timeout=YTDLP_DETECT_TIMEOUT).returncode == 0
+    except Exception: return False
+
 def find_ytdlp():
-    global YTDLP_CMD
-    for c in [[sys.executable,"-m","yt_dlp"],["yt-dlp"],["yt_dlp"]]:
+    """First working candidate in preference order, or None. Only successes are cached, so a probe
+    that failed (perhaps a timeout at a busy boot) is retried on the next start."""
+    try: known = {fp for fp, ok in json.loads(YTDLP_DETECT_CACHE.read_text()).items() if ok is True}
+    except (OSError, ValueError, AttributeError): known = set()
+    candidates = [(c, fp) for c in ytdlp_candidates() for fp in [ytdlp_fingerprint(c)] if fp]
+    # only candidates preferred over the best known-good one need probing
+    best = next((i for i, (c, fp) in enumerate(candidates) if fp in known), len(candidates))
+    todo = candidates[:best]
+    if todo:
+        with ThreadPoolExecutor(len(todo)) as pool:
+            for (c, fp), ok in zip(todo, pool.map(lambda t: probe_ytdlp(t[0]), todo)):
+                if ok: known.add(fp)
+        try:
+            tmp = YTDLP_DETECT_CACHE.with_suffix(f".{os.getpid()}.tmp")
+            tmp.write_text(json.dumps({fp: True for c, fp in candidates if fp in known}))
+            os.replace(tmp, YTDLP_DETECT_CACHE)
+        except OSError as e: print(f"yt-dlp detection cache not saved: {e}")
+    return next((c for c, fp in candidates if fp in known), None)
+
+class YtdlpDetector:
+    def __init__(self):
+        self.cmd, self.done = None, threading.Event()
+        self._pid, self._lock = None, threading.Lock()
+
+    def start(self):
+        # a detection still running at fork time does not carry over, so the worker restarts it
+        with self._lock:
+            if self.done.is_set() or self._pid == os.getpid(): return
+            self._pid = os.getpid()
+        threading.Thread(target=self._detect, daemon=True, name="ytdlp-detect").start()
+
+    def _detect(self):
+        t0 = time.perf_counter()
+        try: self.cmd = find_ytdlp()
+        except Exception as e: print(f"yt-dlp detection failed: {e}")
+        if self.cmd: print(f"✅ yt-dlp: {self.cmd} ({1000*(time.perf_counter()-t0):.0f} ms)")
+        else: print("❌ yt-dlp not found")
+        self.done.set()
+
+ytdlp_detector = YtdlpDetector()
+
+def ytdlp_cmd(wait=True):
+    """The yt-dlp command line, or None if there is none. Waits for detection unless wait=False."""
+    if not ytdlp_detector.done.is_set():
+        ytdlp_detector.start()
+        if wait: ytdlp_detector.done.wait(len(ytdlp_candidates())*YTDLP_DETECT_TIMEOUT)
+    return ytdlp_detector.cmd
+
+if YTDLP_DETECT == "eager": ytdlp_cmd()
+
+# ── yt-dlp scheduler ──
+# Every yt-dlp run takes a slot in one of two lanes: "search" for ID lookups and URL resolution
+# (fast, many in parallel) and "download" for extract+transcode (slow, CPU-bound). Waiters are
+# served by priority, and a lane whose wait queue is full rejects new work with 503 + Retry-After.
+# Lanes are per process: the download lane's default splits the usable cores between the
+# WEB_CONCURRENCY worker processes (gunicorn and uvicorn default to one per core), so a box runs
+# about one transcode per core in total. wsgi.py sets WEB_CONCURRENCY=1 for its single-process
+# servers (waitress, dev); set it, or YTDLP_DOWNLOAD_SLOTS, when running one process some other way.
+PRIORITY_HIGH, PRIORITY_NORMAL, PRIORITY_LOW = 0, 1, 2   # interactive, download jobs, prefetch
+YTDLP_SEARCH_SLOTS = int(os.environ.get("YTDLP_SEARCH_SLOTS", 8))
+YTDLP_SEARCH_QUEUE = int(os.environ.get("YTDLP_SEARCH_QUEUE", 64))
+WORKER_PROCESSES = int(os.environ.get("WEB_CONCURRENCY", available_cpus()))   # same default as gunicorn.conf.py
+YTDLP_DOWNLOAD_SLOTS = int(os.environ.get("YTDLP_DOWNLOAD_SLOTS", max(1, available_cpus()//WORKER_PROCESSES)))
+YTDLP_DOWNLOAD_QUEUE = int(os.environ.get("YTDLP_DOWNLOAD_QUEUE", 32))
+
+class Saturated(Exception):
+    """A yt-dlp lane is full; the route answers 503 with Retry-After."""
+    def __init__(self, lane, retry_after):
+        super().__init__(f"yt-dlp {lane} lane is saturated")
+        self.lane, self.retry_after = lane, retry_after
+
+class Lane:
+    """Bounded pool of run slots with a priority-ordered wait queue of limited depth. Threads wait
+    in acquire(); coroutines wait in acquire_async() on their event loop, in the same queue."""
+    def __init__(self, name, slots, max_queue, retry_after):
+        self.name, self.slots, self.max_queue, self.retry_after = name, slots, max_queue, retry_after
+        self._cv, self._waiting, self._seq = threading.Condition(), [], itertools.count()
+        self._async = {}  # entry -> (loop, asyncio.Event) of each coroutine waiting
+        self.active = self.rejected = self.started = 0
+        self.wait_total = self.wait_max = 0.0
+
+    def _enqueue(self, priority):
+        if self.active >= self.slots and len(self._waiting) >= self.max_queue:
+            self.rejected += 1; raise Saturated(self.name, self.retry_after)
+        entry = (priority, next(self._seq))
+        heapq.heappush(self._waiting, entry)
+        return entry
+
+    def _try_take(self, entry, t0):
+        """Take a slot if entry is first in line and one is free; returns the seconds waited or None."""
+        if self.active >= self.slots or self._waiting[0] != entry: return None
+        heapq.heappop(self._waiting)
+        self.active += 1; self.started += 1
+        waited = time.monotonic()-t0
+        self.wait_total += waited; self.wait_max = max(self.wait_max, waited)
+        self._wake()  # the next waiter in line may also fit
+        return waited
+
+    def _give_up(self, entry):
+        self._waiting.remove(entry); heapq.heapify(self._waiting)
+        self._wake()
+
+    def _wake(self):
+        """Have every waiter re-check the queue (called with _cv held)."""
+        self._cv.notify_all()
+        for loop, event in self._async.values():
+            try: loop.call_soon_threadsafe(event.set)
+            except RuntimeError: pass  # loop closed
+
+    def acquire(self, priority=PRIORITY_HIGH, timeout=None):
+        """Wait for a slot and return the seconds spent queued. Raises Saturated if the queue is
+        full or no slot frees up within timeout."""
+        t0 = time.monotonic()
+        with self._cv:
+            entry = self._enqueue(priority)
+            while (waited := self._try_take(entry, t0)) is None:
+                left = None if timeout is None else timeout-(time.monotonic()-t0)
+                if left is not None and left <= 0:
+                    self._give_up(entry); self.rejected += 1
+                    raise Saturated(self.name, self.retry_after)
+                self._cv.wait(left)
+        return waited
+
+    async def acquire_async(self, priority=PRIORITY_HIGH, timeout=None):
+        """acquire() for coroutines: waits on the event loop rather than in an executor thread."""
+        t0, event = time.monotonic(), asyncio.Event()
+        with self._cv:
+            entry = self._enqueue(priority)
+            self._async[entry] = (asyncio.get_running_loop(), event)
+        try:
+            while True:
+                with self._cv:
+                    waited = self._try_take(entry, t0)
+                    if waited is not None: return waited
+                    event.clear()  # wake-ups from here on arrive through call_soon_threadsafe, after this
+                left = None if timeout is None else timeout-(time.monotonic()-t0)
+                if left is not None and left <= 0:
+                    with self._cv: self._give_up(entry); self.rejected += 1
+                    raise Saturated(self.name, self.retry_after)
+                try: await asyncio.wait_for(event.wait(), left)
+                except asyncio.TimeoutError: pass
+        except asyncio.CancelledError:
+            with self._cv:
+                if entry in self._waiting: self._give_up(entry)
+            raise
+        finally:
+            with self._cv: self._async.pop(entry, None)
+
+    def release(self):
+        with self._cv:
+            self.active -= 1; self._wake()
+
+    def stats(self):
+        with self._cv:
+            return {"active":self.active,"slots":self.slots,"queued":len(self._waiting),"max_queue":self.max_queue,
+                    "started":self.started,"rejected":self.rejected,
+                    "wait_avg_ms":round(1000*self.wait_total/max(1,self.started),1),
+                    "wait_max_ms":round(1000*self.wait_max,1)}
+
+LANES = {"search": Lane("search", YTDLP_SEARCH_SLOTS, YTDLP_SEARCH_QUEUE, retry_after=5),
+         "download": Lane("download", YTDLP_DOWNLOAD_SLOTS, YTDLP_DOWNLOAD_QUEUE, retry_after=30)}
+
+@app.errorhandler(Saturated)
+def saturated(e):
+    return jsonify({"error":"Busy, retry later","lane":e.lane}), 503, {"Retry-After": str(e.retry_after)}
+
+# ── In-process yt-dlp ──
+# Drives yt_dlp.YoutubeDL from a small thread pool instead of paying an interpreter start and
+# the yt-dlp import on every call. The subprocess path stays as fallback (YTDLP_MODE=subprocess).
+YTDLP_MODE = os.environ.get("YTDLP_MODE", "inprocess")   # inprocess | subprocess
+YTDLP_WORKERS = int(os.environ.get("YTDLP_WORKERS", YTDLP_SEARCH_SLOTS+YTDLP_DOWNLOAD_SLOTS))  # lanes do the limiting
+try: import yt_dlp
+except ImportError: yt_dlp = None
+
+class YtdlpResult:
+    """Same contract as subprocess.CompletedProcess: returncode, stdout, stderr."""
+    def __init__(self, returncode, stdout="", stderr=""):
+        self.returncode, self.stdout, self.stderr = returncode, stdout, stderr
+
+if yt_dlp:
+    class _CapturingYDL(yt_dlp.YoutubeDL):
+        """Collects what the CLI would print to stdout (--dump-json, --get-url, ...)."""
+        captured = on_progress = None
+        def to_stdout(self, message, *a, **k): self.captured.append(message)
+        def _progress_hook(self, d):
+            total = d.get("total_bytes") or d.get("total_bytes_estimate")
+            if self.on_progress and d.get("status") == "downloading" and total:
+                self.on_progress(min(100.0, 100.0*d.get("downloaded_bytes",0)/total))
+
+class _YdlLogger:
+    def __init__(self): self.errors = []
+    def debug(self, msg): pass
+    def info(self, msg): pass
+    def warning(self, msg): pass
+    def error(self, msg): self.errors.append(msg)
+
+_ydl_local = threading.local()   # per worker thread: OrderedDict of warm YoutubeDL instances
+_ydl_pool = ThreadPoolExecutor(YTDLP_WORKERS, thread_name_prefix="ytdlp")
+
+def _ydl_run(args, progress=None):
+    try:
+        po = yt_dlp.parse_options(args)
+        # reuse an instance built from the same options; only the URLs and the output template
+        # (a per-call temp name) differ between calls, so neither is part of the key
+        key = tuple(a for i, a in enumerate(args) if a not in po.urls and (i == 0 or args[i-1] not in ("-o","--output")))
+        ydls = getattr(_ydl_local, "ydls", None)
+        if ydls is None: ydls = _ydl_local.ydls = OrderedDict()
+        ydl = ydls.pop(key, None)
+        if ydl is None:
+            ydl = _CapturingYDL(dict(po.ydl_opts, ignoreerrors=False, logger=_YdlLogger()))
+            ydl.add_progress_hook(ydl._progress_hook)
+        ydls[key] = ydl
+        while len(ydls) > 4: ydls.popitem(last=False)[1].close()
+        if po.ydl_opts.get("outtmpl"): ydl.params["outtmpl"].update(po.ydl_opts["outtmpl"])
+        ydl.captured, ydl.on_progress, log = [], progress, ydl.params["logger"]
+        log.errors = []
         try:
-            r = subprocess.run(c+["--version"],capture_output=True,text=True,timeout=10)
-            if r.returncode==0: YTDLP_CMD=c; print(f"✅ yt-dlp: {c}"); return
-        except: continue
-    print("❌ yt-dlp not found")
-find_ytdlp()
-
-def run_ytdlp(args, timeout=120):
-    if not YTDLP_CMD:
-        class F: returncode=1;stdout="";stderr="not found"
-        return F()
-    try: return subprocess.run(YTDLP_CMD+args,capture_output=True,text=True,timeout=timeout)
-    except subprocess.TimeoutExpired:
-        class T: returncode=1;stdout="";stderr="timeout"
-        return T()
+            ydl.download(po.urls); rc = 0
+        except (Exception, SystemExit) as e:
+            rc = 1
+            if not log.errors: log.errors.append(str(e))
+        out = "".join(m+"\n" for m in ydl.captured)
+        return YtdlpResult(rc, out, "\n".join(log.errors))
+    except (Exception, SystemExit) as e:
+        return YtdlpResult(1, "", str(e))
+
+_PROGRESS_RE = re.compile(r"^\[download\]\s+(\d+(?:\.\d+)?)%")
+
+def _run_subprocess_progress(args, timeout, progress):
+    """subprocess.run() equivalent that feeds yt-dlp's --newline progress lines to a callback."""
+    p = subprocess.Popen(ytdlp_cmd()+args+["--newline","--progress"],
+                         stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+    timed_out = []
+    timer = threading.Timer(timeout, lambda: (timed_out.append(1), p.kill()))
+    err = []
+    drain = threading.Thread(target=lambda: err.append(p.stderr.read()), daemon=True)
+    timer.start(); drain.start()
+    out = []
+    try:
+        for line in p.stdout:
+            m = _PROGRESS_RE.match(line)
+            if m: progress(float(m.group(1)))
+            else: out.append(line)
+        p.wait(); drain.join()
+    except BaseException:  # the callback may raise to cancel the download
+        p.kill(); p.wait(); raise
+    finally: timer.cancel()
+    if timed_out: return YtdlpResult(1, "", "timeout")
+    return YtdlpResult(p.returncode, "".join(out), "".join(err))
+
+def run_ytdlp(args, timeout=120, progress=None, lane="search", priority=PRIORITY_HIGH):
+    """Run yt-dlp with CLI arguments in a scheduler lane; time spent queued counts against timeout.
+    progress, if given, is called with the download percentage. Raises Saturated if the lane is full."""
+    with span("ytdlp_wait"): waited = LANES[lane].acquire(priority, timeout)
+    t0 = time.perf_counter()
+    try:
+        with span("ytdlp"): result = _run_ytdlp(args, timeout-waited, progress)
+    finally: LANES[lane].release()
+    observe_ytdlp(ytdlp_op(args, lane), time.perf_counter()-t0, result)
+    return result
+
+def ytdlp_op(args, lane):
+    return "get-url" if "--get-url" in args else "download" if lane == "download" else "search"
+
+def observe_ytdlp(op, seconds, result):
+    outcome = "ok" if result.returncode == 0 else "timeout" if result.stderr == "timeout" else "error"
+    ytdlp_runs.inc(op=op, outcome=outcome); ytdlp_latency.observe(seconds, op=op)
+
+def _run_ytdlp(args, timeout, progress):
+    if YTDLP_MODE == "inprocess" and yt_dlp:
+        # a timed-out call keeps its worker until yt-dlp's own socket timeouts fire
+        try: return _ydl_pool.submit(_ydl_run, args, progress).result(timeout=timeout)
+        except FuturesTimeout: return YtdlpResult(1, "", "timeout")
+    if not ytdlp_cmd(): return YtdlpResult(1, "", "not found")
+    if progress: return _run_subprocess_progress(args, timeout, progress)
+    try: return subprocess.run(ytdlp_cmd()+args,capture_output=True,text=True,timeout=timeout)
+    except subprocess.TimeoutExpired: return YtdlpResult(1, "", "timeout")
+
+# ── Deezer HTTP ──
+DEEZER_API = os.environ.get("DEEZER_API", "https://api.deezer.com")
+DEEZER_POOL_SIZE = int(os.environ.get("DEEZER_POOL_SIZE", 16))          # idle keep-alive connections kept
+DEEZER_CONNECT_TIMEOUT = float(os.environ.get("DEEZER_CONNECT_TIMEOUT", 3))
+DEEZER_READ_TIMEOUT = float(os.environ.get("DEEZER_READ_TIMEOUT", 10))
+DEEZER_PROBE_INTERVAL = float(os.environ.get("DEEZER_PROBE_INTERVAL", 30))  # reachability check for readiness
+
+class HTTPPool:
+    """Thread-safe pool of keep-alive HTTP/1.1 connections to a single origin. Never blocks:
+    when every pooled connection is busy a new one is opened, and surplus ones are closed on return."""
+    def __init__(self, base_url, size, connect_timeout, read_timeout):
+        u = urllib.parse.urlsplit(base_url)
+        self.conn_cls = http.client.HTTPSConnection if u.scheme == "https" else http.client.HTTPConnection
+        self.host, self.connect_timeout, self.read_timeout = u.netloc, connect_timeout, read_timeout
+        self.size, self._pid = size, None
+
+    @property
+    def idle(self):
+        # sockets inherited from a preloading parent must not be shared with it, so each process starts empty
+        if self._pid != os.getpid():
+            self._idle = queue.LifoQueue(self.size)  # LIFO: the most recently used connection is least likely stale
+            self._pid = os.getpid()
+        return self._idle
+
+    def _connect(self):
+        conn = self.conn_cls(self.host, timeout=self.connect_timeout)
+        conn.connect()
+        conn.sock.settimeout(self.read_timeout)
+        return conn
+
+    def get(self, path):
+        """GET path and return (status, body). Retries once if a reused connection turns out stale."""
+        for attempt in (0, 1):
+            try: conn, reused = self.idle.get_nowait(), True
+            except queue.Empty: conn, reused = self._connect(), False
+            try:
+                conn.request("GET", path, headers={"User-Agent":"Mozilla/5.0"})
+                r = conn.getresponse()
+                body = r.read()
+            except (ConnectionError, http.client.HTTPException):
+                conn.close()
+                if reused and attempt == 0: continue
+                raise
+            except Exception:
+                conn.close(); raise
+            if r.will_close: conn.close()
+            else:
+                try: self.idle.put_nowait(conn)
+                except queue.Full: conn.close()
+            return r.status, body
+
+deezer_pool = HTTPPool(DEEZER_API, DEEZER_POOL_SIZE, DEEZER_CONNECT_TIMEOUT, DEEZER_READ_TIMEOUT)
+
+class DeezerProbe:
+    """Whether Deezer answered lately. Real API calls report their outcome here; the background
+    probe only sends its own request when nothing else has talked to Deezer for `interval` seconds."""
+    def __init__(self, interval):
+        self.interval, self.ok, self.at, self.error = interval, None, 0.0, None
+        self._pid, self._lock = None, threading.Lock()
+
+    def record(self, ok, error=None):
+        self.ok, self.at, self.error = ok, time.time(), None if ok else error
+
+    def start(self):
+        # one prober per process, like TrendingFeed: preloaded gunicorn workers start theirs on first use
+        with self._lock:
+            if self._pid == os.getpid(): return
+            self._pid = os.getpid()
+        threading.Thread(target=self._loop, daemon=True, name="deezer-probe").start()
+
+    def _loop(self):
+        while True:
+            if time.time()-self.at >= self.interval:
+                try: deezer_get("/search", q="a", limit=1)
+                except Exception: pass  # deezer_get has recorded the failure
+            time.sleep(max(1, self.interval-(time.time()-self.at)))
+
+    def stats(self):
+        self.start()
+        return {"ok":self.ok,"age_s":round(time.time()-self.at, 1) if self.at else None,"error":self.error}
+
+deezer_probe = DeezerProbe(DEEZER_PROBE_INTERVAL)
+
+def deezer_get(path, **params):
+    """GET a Deezer API path over the shared connection pool and decode the JSON body."""
+    t0, outcome, error = time.perf_counter(), "error", None
+    try:
+        with span("deezer"): status, body = deezer_pool.get(f"{path}?{urllib.parse.urlencode(params)}")
+        if status != 200: raise IOError(f"Deezer HTTP {status}")
+        outcome = "ok"
+    except Exception as e:
+        if isinstance(e, TimeoutError): outcome = "timeout"
+        error = str(e) or type(e).__name__; raise
+    finally:
+        deezer_requests.inc(outcome=outcome); deezer_latency.observe(time.perf_counter()-t0)
+        deezer_probe.record(outcome == "ok", error)
+    with span("decode"): return json_loads(body)
+
+def deezer_song(t):
+    """Song dict for one Deezer track object."""
+    return {
+        "id": str(t.get('id')),
+        "title": t.get('title','Unknown'),
+        "artist": t.get('artist',{}).get('name','Unknown'),
+        "album": t.get('album',{}).get('title',''),
+        "duration": t.get('duration',0),
+        "duration_str": f"{t.get('duration',0)//60}:{t.get('duration',0)%60:02d}",
+        "thumbnail": t.get('album',{}).get('cover_medium',''),
+        "preview": t.get('preview',''),  # 30-sec free preview MP3
+        "deezer_id": str(t.get('id')),
+        # Search YouTube for full song playback
+        "yt_query": f"{t.get('artist',{}).get('name','')} {t.get('title','')} official audio",
+    }
 
 def deezer_search(query, limit=20):
     """Search Deezer for tracks - free, no API key."""
     try:
-        url = f"https://api.deezer.com/search?q={urllib.parse.quote(query)}&limit={limit}&output=json"
-        req = urllib.request.Request(url, headers={'User-Agent':'Mozilla/5.0'})
-        with urllib.request.urlopen(req, timeout=10) as r:
-            data = json.loads(r.read().decode())
-        
-        songs = []
-        for t in data.get('data', []):
-            songs.append({
-                "id": str(t.get('id')),
-                "title": t.get('title','Unknown'),
-                "artist": t.get('artist',{}).get('name','Unknown'),
-                "album": t.get('album',{}).get('title',''),
-                "duration": t.get('duration',0),
-                "duration_str": f"{t.get('duration',0)//60}:{t.get('duration',0)%60:02d}",
-                "thumbnail": t.get('album',{}).get('cover_medium',''),
-                "preview": t.get('preview',''),  # 30-sec free preview MP3
-                "deezer_id": str(t.get('id')),
-                # Search YouTube for full song playback
-                "yt_query": f"{t.get('artist',{}).get('name','')} {t.get('title','')} official audio",
-            })
-        return songs
+        data = deezer_get("/search", q=query, limit=limit, output="json")
+        return [deezer_song(t) for t in data.get('data', [])]
     except Exception as e:
         print(f"Deezer search failed: {e}")
         return []
 
-def get_yt_id(query):
-    """Get YouTube video ID for a song query."""
+def deezer_track(deezer_id):
+    """Song dict for a single Deezer track id, or None if it does not exist."""
     try:
-        result = run_ytdlp([
-            f"ytsearch1:{query}",
+        t = deezer_get(f"/track/{urllib.parse.quote(str(deezer_id), safe='')}")
+        if t.get('error') or not t.get('id'): return None  # unknown ids come back as 200 {"error": ...}
+        return deezer_song(t)
+    except Exception as e:
+        print(f"Deezer track lookup failed: {e}")
+        return None
+
+track_lookups = SingleFlight()
+
+def cached_track(deezer_id):
+    """deezer_track through the per-id metadata cache; concurrent lookups of one id share a request."""
+    deezer_id = str(deezer_id)
+    song = track_cache.get(deezer_id)
+    if song is None:
+        song = track_lookups.do(deezer_id, lambda: deezer_track(deezer_id))
+        if song: track_cache.set(deezer_id, song)
+    return song
+
+# The cache lookups and stores below are split from the Deezer / yt-dlp calls between them, so
+# asgi.py runs the same cache code (off its event loop) around its async clients.
+def search_key(query, limit):
+    return f"{normalize_query(query)}_{limit}"
+
+def search_cached(query, limit):
+    with span("search_cache"): return search_cache.get(search_key(query, limit))
+
+def search_store(query, limit, songs):
+    if songs: search_cache.set(search_key(query, limit), songs)  # empty results are not cached
+
+def cached_search(query, limit=20):
+    """deezer_search through the shared search cache."""
+    songs = search_cached(query, limit)
+    if songs is None:
+        songs = deezer_search(query, limit); search_store(query, limit, songs)
+    return songs
+
+search_bodies = TTLCache(SEARCH_CACHE_MAX, SEARCH_CACHE_BYTES, SEARCH_CACHE_TTL, sizeof=lambda v: len(v[1]))
+
+def search_body(query, limit=20):
+    """(songs, songs as JSON bytes) for cached_search, memoized per process so a repeat search
+    skips both the shared-cache decode and serialization."""
+    return search_bodies.get(search_key(query, limit)) or encode_search_body(query, limit, cached_search(query, limit))
+
+def encode_search_body(query, limit, songs):
+    hit = (songs, app.json.encode(songs))
+    if songs: search_bodies.set(search_key(query, limit), hit)
+    return hit
+
+def search_json(query, songs_json):
+    """{"query":..., "results":...} body, spliced in the sorted key order app.json writes."""
+    return b'{"query":' + app.json.encode(query) + b',"results":' + songs_json + b'}'
+
+def ytid_args(query):
+    return [f"ytsearch1:{query}",
             "--dump-json","--no-playlist","--skip-download",
-            "--quiet","--no-warnings","--socket-timeout","20"
-        ], timeout=40)
-        if result.stdout:
-            d = json.loads(result.stdout.strip().split('\n')[0])
-            return d.get('id')
-    except: pass
+            "--quiet","--no-warnings","--socket-timeout","20"]
+
+def ytid_from_result(key, result):
+    """Parse a ytsearch1 result and cache it under key, including "Not found"."""
+    if result.stdout.strip():
+        vid = json.loads(result.stdout.strip().split('\n')[0]).get('id')
+        if vid: yt_id_cache.set(key, vid)
+        return vid
+    if result.returncode==0:  # search ran fine and found nothing; timeouts/errors are not cached
+        yt_id_cache.set(key, "", ttl=YTID_NEGATIVE_TTL)
     return None
 
+def cached_yt_id(query):
+    """(key, cached): cached is the video id, "" for a remembered miss, or None if not cached."""
+    key = normalize_query(query)
+    with span("yt_id_cache"): return key, yt_id_cache.get(key)
+
+def get_yt_id(query, priority=PRIORITY_HIGH):
+    """Get YouTube video ID for a song query. Results, including misses, are cached."""
+    key, cached = cached_yt_id(query)
+    if cached is not None: return cached or None
+    try: return ytid_from_result(key, run_ytdlp(ytid_args(query), timeout=40, priority=priority))
+    except Saturated: raise
+    except: return None
+
+# ── YouTube ID prefetch ──
+# After a search, the top results' yt_query values are resolved in the background so the likely
+# click is already a cache hit. One thread per process, rate-limited, with a bounded queue that
+# drops work when full, so prefetching never competes seriously with foreground lookups.
+PREFETCH_YT_IDS = int(os.environ.get("PREFETCH_YT_IDS", 0))        # top N results per search, 0 = off
+PREFETCH_RATE = float(os.environ.get("PREFETCH_RATE", 0.5))        # uncached lookups per second per process, 0 = unlimited
+PREFETCH_QUEUE = int(os.environ.get("PREFETCH_QUEUE", 200))
+
+class Prefetcher:
+    def __init__(self, rate, maxsize):
+        self.interval, self.maxsize = 1/rate if rate > 0 else 0.0, maxsize
+        self._pid, self._lock, self._pending = None, threading.Lock(), set()
+        self.resolved = self.dropped = 0
+
+    def submit(self, queries):
+        with self._lock:
+            if self._pid != os.getpid():  # threads do not survive a fork
+                self._pid, self.q, self._pending = os.getpid(), queue.Queue(self.maxsize), set()
+                threading.Thread(target=self._loop, daemon=True, name="yt-prefetch").start()
+            for q in queries:
+                key = normalize_query(q)
+                if key in self._pending: continue
+                try: self.q.put_nowait((key, q)); self._pending.add(key)
+                except queue.Full: self.dropped += 1
+
+    def _loop(self):
+        next_at = 0.0
+        while True:
+            key, q = self.q.get()
+            try:
+                if yt_id_cache.get(key) is not None: continue  # cache hits do not use up the rate
+                time.sleep(max(0.0, next_at-time.monotonic()))
+                next_at = time.monotonic() + self.interval
+                get_yt_id(q, PRIORITY_LOW); self.resolved += 1
+            except Saturated: pass  # foreground work has the lane; drop it
+            except Exception as e: print(f"yt_id prefetch failed: {e}")
+            finally:
+                with self._lock: self._pending.discard(key)
+
+    def stats(self):
+        return {"queued":self.q.qsize() if self._pid == os.getpid() else 0,"resolved":self.resolved,"dropped":self.dropped}
+
+yt_prefetcher = Prefetcher(PREFETCH_RATE, PREFETCH_QUEUE)
+
+# ── Trending feed ──
+# Built in the background every TRENDING_REFRESH seconds and served from memory, so the homepage
+# route never waits on Deezer; a stale feed keeps being served until a refresh succeeds.
+TRENDING_SOURCE = os.environ.get("TRENDING_SOURCE", "search")            # search | chart
+TRENDING_QUERY = os.environ.get("TRENDING_QUERY", f"top hits {os.environ.get('TRENDING_YEAR', time.localtime().tm_year)}")
+TRENDING_FALLBACK_QUERY = os.environ.get("TRENDING_FALLBACK_QUERY", "popular songs")
+TRENDING_CHART = os.environ.get("TRENDING_CHART", "/chart/0/tracks")    # Deezer chart endpoint
+TRENDING_REFRESH = float(os.environ.get("TRENDING_REFRESH", 600))
+TRENDING_INITIAL_WAIT = float(os.environ.get("TRENDING_INITIAL_WAIT", 3))  # seconds a request waits for the first build
+
+def build_trending(limit=20):
+    songs = []
+    if TRENDING_SOURCE == "chart":
+        try: songs = [deezer_song(t) for t in deezer_get(TRENDING_CHART, limit=limit).get('data', [])]
+        except Exception as e: print(f"Deezer chart failed: {e}")
+    else:
+        songs = deezer_search(TRENDING_QUERY, limit)
+    return songs or deezer_search(TRENDING_FALLBACK_QUERY, limit)
+
+class TrendingFeed:
+    def __init__(self, build, interval):
+        self.build, self.interval = build, interval
+        self.songs, self.updated, self._body = None, 0.0, None
+        self.first_build = threading.Event()  # set once the first refresh has been tried
+        self._pid, self._lock = None, threading.Lock()
+
+    def start(self):
+        # one refresher per process; threads do not survive a fork, so workers start their own
+        with self._lock:
+            if self._pid == os.getpid(): return
+            self._pid = os.getpid()
+        threading.Thread(target=self._loop, daemon=True, name="trending").start()
+
+    def _loop(self):
+        while True:
+            if time.time()-self.updated >= self.interval:
+                try:
+                    songs = self.build()
+                    if songs: self.songs, self.updated = songs, time.time()
+                except Exception as e: print(f"Trending refresh failed: {e}")
+                self.first_build.set()
+            time.sleep(min(30, self.interval))  # failed refreshes are retried sooner
+
+    def get(self):
+        self.start()
+        if self.songs is None: self.first_build.wait(TRENDING_INITIAL_WAIT)  # fresh process: briefly wait for the first build
+        return self.songs or []
+
+    def body(self):
+        """{"trending": songs} as JSON bytes, encoded once per refresh."""
+        songs, cached = self.get(), self._body
+        if cached is None or cached[0] is not songs:
+            cached = self._body = (songs, app.json.encode({"trending": songs}))
+        return cached[1]
+
+trending_feed = TrendingFeed(build_trending, TRENDING_REFRESH)
+
+# ── Audio cache quota ──
+AUDIO_CACHE_BYTES = int(os.environ.get("AUDIO_CACHE_BYTES", 5*1024**3))  # quota
+AUDIO_CACHE_HIGH = float(os.environ.get("AUDIO_CACHE_HIGH", 0.95))      # start evicting above this share of the quota
+AUDIO_CACHE_LOW = float(os.environ.get("AUDIO_CACHE_LOW", 0.80))        # ...and stop once below this one
+ORPHAN_AGE = 600  # leftovers older than twice the download timeout belong to no live yt-dlp run
+
+class AudioCache:
+    """Keeps CACHE_DIR under a byte quota. Sizes and last-access times live in a small SQLite
+    index, so eviction (least recently accessed first) never has to stat the whole directory."""
+    LEFTOVER_SUFFIXES = (".part", ".ytdl", ".webm", ".m4a", ".opus", ".temp")
+
+    def __init__(self, directory, quota, high, low):
+        self.dir, self.quota, self.high, self.low = directory, quota, high, low
+        self.index_path = str(directory/".index.db")
+        self._local = threading.local()
+        self._evict_lock = threading.Lock()
+        self._pid, self._lock = None, threading.Lock()
+        self.evictions = self.hits = self.misses = 0
+        self._db().execute("CREATE TABLE IF NOT EXISTS files (video_id TEXT PRIMARY KEY, size INTEGER, accessed REAL)")
+        self._db().execute("CREATE INDEX IF NOT EXISTS files_lru ON files (accessed)")
+
+    def _db(self): return sqlite_conn(self._local, self.index_path)
+
+    def count(self, hit):
+        """Record whether a request found its song already on disk."""
+        if hit: self.hits += 1
+        else: self.misses += 1
+
+    def touch(self, video_id):
+        try: self._db().execute("UPDATE files SET accessed=? WHERE video_id=?", (time.time(),video_id))
+        except sqlite3.Error as e: print(f"Audio index update failed: {e}")
+
+    def add(self, video_id, size):
+        try: self._db().execute("INSERT OR REPLACE INTO files VALUES (?,?,?)", (video_id,size,time.time()))
+        except sqlite3.Error as e: print(f"Audio index update failed: {e}")
+        self.evict()
+
+    def total(self):
+        return self._db().execute("SELECT COALESCE(SUM(size),0) FROM files").fetchone()[0]
+
+    def evict(self):
+        """Drop least recently accessed files once above the high watermark, down to the low one."""
+        if not self.quota or not self._evict_lock.acquire(blocking=False): return
+        try:
+            total = self.total()
+            if total <= self.high*self.quota: return
+            rows = self._db().execute("SELECT video_id, size FROM files ORDER BY accessed").fetchall()
+            for video_id, size in rows:
+                if total <= self.low*self.quota: break
+                (self.dir/f"{video_id}.mp3").unlink(missing_ok=True)
+                self._db().execute("DELETE FROM files WHERE video_id=?", (video_id,))
+                total -= size; self.evictions += 1
+        except sqlite3.Error as e: print(f"Audio cache eviction failed: {e}")
+        finally: self._evict_lock.release()
+
+    def start(self):
+        # every worker scans once, in the background; the scan is safe against the others' writes
+        with self._lock:
+            if self._pid == os.getpid(): return
+            self._pid = os.getpid()
+        threading.Thread(target=self.scan, daemon=True, name="audio-cache-scan").start()
+
+    def scan(self):
+        """Startup pass: sync the index with the files on disk and remove leftovers of failed yt-dlp runs."""
+        now, found = time.time(), {}
+        for f in self.dir.iterdir():
+            try:
+                st = f.stat()
+                if f.suffix == ".mp3" and ".tmp-" not in f.name and ".temp" not in f.name:
+                    found[f.stem] = st
+                elif (".tmp-" in f.name or f.suffix in self.LEFTOVER_SUFFIXES) and now-st.st_mtime > ORPHAN_AGE:
+                    f.unlink(); print(f"🧹 removed leftover {f.name}")
+            except OSError: continue
+        db = self._db()
+        with db:
+            db.execute("BEGIN IMMEDIATE")
+            # rows added since the directory was listed belong to files it may have missed; keep them
+            gone = [(v,) for (v,) in db.execute("SELECT video_id FROM files WHERE accessed<?", (now,)) if v not in found]
+            db.executemany("DELETE FROM files WHERE video_id=?", gone)
+            db.executemany("INSERT INTO files VALUES (?,?,?) ON CONFLICT (video_id) DO UPDATE SET size=excluded.size",
+                           [(v, st.st_size, st.st_mtime) for v, st in found.items()])
+        self.evict()
+
+    def stats(self):
+        try: files, size = self._db().execute("SELECT COUNT(*), COALESCE(SUM(size),0) FROM files").fetchone()
+        except sqlite3.Error: files = size = None
+        return {"files":files,"bytes":size,"quota":self.quota,"evictions":self.evictions,
+                "hits":self.hits,"misses":self.misses}
+
+audio_cache = AudioCache(CACHE_DIR, AUDIO_CACHE_BYTES, AUDIO_CACHE_HIGH, AUDIO_CACHE_LOW)
+
+# ── Audio downloads ──
+downloads = SingleFlight()
+VIDEO_ID_RE = re.compile(r"[\w-]{1,64}")  # ids become file names under CACHE_DIR, so nothing path-like gets through
+
+@app.before_request
+def _check_video_id():
+    video_id = (request.view_args or {}).get("video_id")
+    if video_id is not None and not VIDEO_ID_RE.fullmatch(video_id): return jsonify({"error":"Invalid video id"}),400
+
+def cached_mp3(video_id):
+    f = CACHE_DIR / f"{video_id}.mp3"
+    return f if f.exists() and f.stat().st_size > 10000 else None
+
+def fetch_mp3(video_id, progress=None, priority=PRIORITY_HIGH):
+    """Return the cached MP3 for a video, downloading it first if needed.
+    Concurrent requests for the same id share one yt-dlp run."""
+    if cached_mp3(video_id): return cached_mp3(video_id)
+    audio_prefetcher.preempt(video_id)
+    return downloads.do(
+        video_id, lambda: cached_mp3(video_id) or _download_mp3(video_id, progress, priority=priority))
+
+def temp_name(video_id):
+    # yt-dlp writes under a private name; the finished MP3 is renamed into place atomically,
+    # so a half-written file is never served and parallel workers never share an output path
+    return f"{video_id}.tmp-{os.getpid()}-{threading.get_ident()}"
+
+def mp3_args(video_id, tmp, extra=()):
+    return [f"https://www.youtube.com/watch?v={video_id}",
+            "-x","--audio-format","mp3","--audio-quality","192K",
+            "-o",str(CACHE_DIR/f"{tmp}.%(ext)s"),"--no-playlist","--quiet","--no-warnings",*extra]
+
+def commit_mp3(video_id, out):
+    """Move a finished MP3 into the cache as <id>.mp3; returns its path, or None if it is too small."""
+    if not (out.exists() and out.stat().st_size > 10000): return None
+    size = out.stat().st_size
+    os.replace(out, CACHE_DIR/f"{video_id}.mp3")
+    audio_cache.add(video_id, size)
+    return CACHE_DIR/f"{video_id}.mp3"
+
+def remove_temp(tmp):
+    for f in CACHE_DIR.glob(glob.escape(tmp)+".*"): f.unlink(missing_ok=True)
+
+def _download_mp3(video_id, progress=None, extra=(), priority=PRIORITY_HIGH):
+    tmp = temp_name(video_id)
+    try:
+        run_ytdlp(mp3_args(video_id, tmp, extra), timeout=300, progress=progress, lane="download", priority=priority)
+        return commit_mp3(video_id, CACHE_DIR/f"{tmp}.mp3")
+    finally: remove_temp(tmp)
+
+FFMPEG = shutil.which("ffmpeg")
+
+def pipe_cmds(video_id):
+    """yt-dlp (bestaudio to stdout) and ffmpeg (stdin to MP3 on stdout) commands for streaming."""
+    # the pipe needs a real stdout, so this always uses the yt-dlp executable
+    return (ytdlp_cmd()+[f"https://www.youtube.com/watch?v={video_id}","-f","bestaudio/best","-o","-",
+                       "--no-playlist","--quiet","--no-warnings"],
+            [FFMPEG,"-hide_banner","-loglevel","error","-i","pipe:0","-vn","-f","mp3","-b:a","192k","pipe:1"])
+
+def stream_mp3(video_id, chunk=16*1024):
+    """Yield MP3 bytes while yt-dlp is piped through ffmpeg, teeing them into the cache.
+    The tee only becomes <id>.mp3 if the whole pipeline finishes cleanly."""
+    yt_cmd, ff_cmd = pipe_cmds(video_id)
+    yt = subprocess.Popen(yt_cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    ff = subprocess.Popen(ff_cmd, stdin=yt.stdout, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    yt.stdout.close()  # ffmpeg owns the read end now
+    kill = lambda: (yt.kill(), ff.kill())
+    timed_out = []
+    watchdog = threading.Timer(300, lambda: (timed_out.append(1), kill())); watchdog.start()
+    tmp = temp_name(video_id)
+    complete, t0 = False, time.perf_counter()
+    try:
+        with open(CACHE_DIR/f"{tmp}.mp3", "wb") as f:
+            while True:
+                data = os.read(ff.stdout.fileno(), chunk)  # returns as soon as ffmpeg has output
+                if not data: break
+                f.write(data)
+                yield data
+        complete = ff.wait() == 0 and yt.wait() == 0
+        if complete: commit_mp3(video_id, CACHE_DIR/f"{tmp}.mp3")
+    finally:  # also runs when the client disconnects (GeneratorExit)
+        watchdog.cancel()
+        if not complete: kill()
+        ff.stdout.close(); ff.wait(); yt.wait()
+        remove_temp(tmp)
+        observe_ytdlp("stream", time.perf_counter()-t0, YtdlpResult(0 if complete else 1, "", "timeout" if timed_out else ""))
+
+AUDIO_MAX_AGE = int(os.environ.get("AUDIO_MAX_AGE", 365*86400))
+
+def mp3_etag(video_id, st):
+    return f"{video_id}-{st.st_size}-{int(st.st_mtime)}"
+
+def serve_mp3(path, video_id):
+    """Send a cached MP3 with byte-range support, strong validators and long-lived caching.
+    Werkzeug answers Range/If-Range with 206, If-None-Match/If-Modified-Since with 304."""
+    with span("send_file"):
+        st = path.stat()
+        rv = send_file(path, mimetype="audio/mpeg", as_attachment=True, download_name=f"{video_id}.mp3",
+                       conditional=True, etag=mp3_etag(video_id, st),
+                       last_modified=st.st_mtime, max_age=AUDIO_MAX_AGE)
+    rv.cache_control.immutable = True  # a video id always maps to the same audio
+    return rv
+
+# ── Speculative audio prefetch ──
+# Clients report where they are in a playlist/session and the next PREFETCH_AUDIO_AHEAD tracks are
+# downloaded into the cache at low priority: few workers, a total bandwidth budget split between them.
+# Every new position for a session drops that session's older, not yet started work, and running
+# downloads are cancelled (from yt-dlp's progress callback) once their track leaves the window or a
+# foreground request needs the same video and downloads it at full speed instead.
+PREFETCH_AUDIO_AHEAD = int(os.environ.get("PREFETCH_AUDIO_AHEAD", 2))
+PREFETCH_AUDIO_WORKERS = int(os.environ.get("PREFETCH_AUDIO_WORKERS", 1))
+PREFETCH_AUDIO_BANDWIDTH = int(os.environ.get("PREFETCH_AUDIO_BANDWIDTH", 2*1024*1024))  # bytes/s in total, 0 = unlimited
+PREFETCH_AUDIO_QUEUE = int(os.environ.get("PREFETCH_AUDIO_QUEUE", 100))
+
+class PrefetchCancelled(Exception):
+    pass
+
+def _track(t):
+    """Song dict for a prefetch entry (song dict or yt_query string), and the key it is known by in a window."""
+    if isinstance(t, str): t = {"yt_query": t}
+    return t, t.get("yt_id") or normalize_query(str(t.get("yt_query","")))
+
+class AudioPrefetcher:
+    def __init__(self, workers, bandwidth, max_queued, max_sessions=10000):
+        self.pool = ThreadPoolExecutor(workers, thread_name_prefix="audio-prefetch")
+        self.rate = bandwidth//workers if bandwidth else 0
+        self.max_queued, self.max_sessions = max_queued, max_sessions
+        self._lock, self._sessions = threading.Lock(), OrderedDict()  # session -> (generation, track keys in window)
+        self._running, self._preempted = set(), set()  # video ids being downloaded / wanted by a foreground request
+        self.queued = self.downloaded = self.cancelled = 0
+
+    def schedule(self, session, tracks):
+        """Replace the session's prefetch window with tracks (song dicts or yt_query strings)."""
+        tracks = [_track(t) for t in tracks]
+        with self._lock:
+            gen = self._sessions.pop(session, (0, ()))[0] + 1
+            self._sessions[session] = (gen, {k for t, k in tracks})
+            while len(self._sessions) > self.max_sessions: self._sessions.popitem(last=False)
+            room = max(0, self.max_queued-self.queued)
+            self.queued += min(room, len(tracks))
+        for t, k in tracks[:room]: self.pool.submit(self._run, session, gen, t, k)
+        return tracks[:room]
+
+    def preempt(self, video_id):
+        """A foreground request is about to download video_id: cancel a prefetch of it that is running."""
+        with self._lock:
+            if video_id in self._running: self._preempted.add(video_id)
+
+    def _stale(self, session, gen):
+        with self._lock: return self._sessions.get(session, (None,))[0] != gen
+
+    def _unwanted(self, session, key, vid):
+        with self._lock: return vid in self._preempted or key not in self._sessions.get(session, (0, ()))[1]
+
+    def _run(self, session, gen, track, key):
+        vid = None
+        try:
+            if self._stale(session, gen): self.cancelled += 1; return
+            vid = track.get("yt_id") or (track.get("yt_query") and get_yt_id(track["yt_query"], PRIORITY_LOW))
+            if not vid or not VIDEO_ID_RE.fullmatch(str(vid)) or cached_mp3(vid): return
+            if self._stale(session, gen): self.cancelled += 1; return
+            extra = ["--limit-rate", str(self.rate)] if self.rate else []
+            cancelled = []
+            def progress(pct):
+                if not cancelled and self._unwanted(session, key, vid): cancelled.append(1); raise PrefetchCancelled()
+            with self._lock: self._running.add(vid)
+            # own single-flight key: a foreground request must not end up waiting on a throttled download
+            try: ok = downloads.do(f"prefetch:{vid}", lambda: cached_mp3(vid) or
+                                   _download_mp3(vid, progress, extra=extra, priority=PRIORITY_LOW))
+            except PrefetchCancelled: ok = None
+            if ok: self.downloaded += 1
+            elif cancelled: self.cancelled += 1
+        except Saturated: self.cancelled += 1
+        except Exception as e: print(f"Audio prefetch failed: {e}")
+        finally:
+            with self._lock:
+                self.queued -= 1
+                if vid: self._running.discard(vid); self._preempted.discard(vid)
+
+    def stats(self):
+        return {"queued":self.queued,"downloaded":self.downloaded,"cancelled":self.cancelled}
+
+audio_prefetcher = AudioPrefetcher(PREFETCH_AUDIO_WORKERS, PREFETCH_AUDIO_BANDWIDTH, PREFETCH_AUDIO_QUEUE)
+
+# ── Download jobs ──
+# POST /api/download/<id> queues a download and returns at once; clients poll /api/jobs/<job_id>
+# and then fetch the file from GET /api/download/<id>. Job state lives in the shared cache backend
+# so any worker can answer a poll.
+DOWNLOAD_WORKERS = int(os.environ.get("DOWNLOAD_WORKERS", max(1, available_cpus()//2)))
+JOB_TTL = float(os.environ.get("JOB_TTL", 3600))   # how long finished jobs stay pollable
+JOB_STALE_AFTER = float(os.environ.get("JOB_STALE_AFTER", 330))  # a running job silent this long has lost its worker
+_job_pool = ThreadPoolExecutor(DOWNLOAD_WORKERS, thread_name_prefix="download")
+job_store = make_cache("jobs", 10000, 0, JOB_TTL)
+jobs_active = Counter("soundwave_download_jobs", "Download jobs in this worker by status.")  # read via a gauge
+_jobs_lock = threading.Lock()
+
+def get_job(job_id):
+    """The stored job, reported as failed if it has been running without an update for JOB_STALE_AFTER
+    (its worker died: OOM, or killed after graceful_timeout)."""
+    job = job_store.get(job_id)
+    if job and job["status"] == "running" and time.time()-job.get("updated", 0) > JOB_STALE_AFTER:
+        job = dict(job, status="failed", error="Worker lost")
+    return job
+
+def submit_download(video_id):
+    """Queue a background download and return its job; an active job for the same video is reused."""
+    with _jobs_lock:
+        job_id = job_store.get(f"video:{video_id}")
+        job = get_job(job_id) if job_id else None
+        if job and job["status"] in ("queued","running"): return job
+        job = {"job_id":uuid.uuid4().hex,"video_id":video_id,"status":"queued","percent":0.0,"error":None,
+               "updated":time.time()}
+        if cached_mp3(video_id): job.update(status="done",percent=100.0)
+        job_store.set(job["job_id"], job); job_store.set(f"video:{video_id}", job["job_id"])
+    if job["status"] == "queued":
+        jobs_active.inc(status="queued"); _job_pool.submit(_run_job, dict(job))
+    return job
+
+def _run_job(job):
+    def save(**changes):
+        job.update(changes, updated=time.time()); job_store.set(job["job_id"], job)
+    def progress(pct):
+        if pct-job["percent"] >= 1 or pct >= 100: save(percent=round(pct, 1))  # throttle writes to the shared store
+    save(status="running")
+    jobs_active.inc(-1, status="queued"); jobs_active.inc(status="running")
+    try: ok = fetch_mp3(job["video_id"], progress, PRIORITY_NORMAL) is not None
+    except Exception as e: ok = False; job["error"] = str(e)
+    finally: jobs_active.inc(-1, status="running")
+    if ok: save(status="done", percent=100.0)
+    else: save(status="failed", error=job["error"] or "Download failed")
+
+# ── Readiness ──
+# /api/health/live only says the process answers. /api/health/ready says whether this instance
+# should get traffic: yt-dlp usable, yt-dlp lane queues below READY_QUEUE_RATIO of their limit,
+# READY_MIN_FREE_BYTES free under CACHE_DIR and Deezer heard from within READY_DEEZER_MAX_AGE.
+READY_QUEUE_RATIO = float(os.environ.get("READY_QUEUE_RATIO", 0.8))
+READY_MIN_FREE_BYTES = int(os.environ.get("READY_MIN_FREE_BYTES", 512*1024**2))
+READY_DEEZER_MAX_AGE = float(os.environ.get("READY_DEEZER_MAX_AGE", 3*DEEZER_PROBE_INTERVAL))
+READY_REQUIRE_DEEZER = os.environ.get("READY_REQUIRE_DEEZER", "1") == "1"   # 0: report Deezer, don't gate on it
+
+def readiness():
+    """(ready, checks); every check is cheap, nothing here waits on yt-dlp or the network."""
+    cmd = ytdlp_cmd(wait=False)
+    checks = {"ytdlp":{"ok":bool(cmd or (YTDLP_MODE == "inprocess" and yt_dlp)),
+                       "detected":ytdlp_detector.done.is_set(),"executable":cmd is not None}}
+    for name, lane in LANES.items():
+        st = lane.stats()
+        checks[f"{name}_lane"] = {"ok":st["queued"] == 0 or st["queued"] < READY_QUEUE_RATIO*st["max_queue"],
+                                  "queued":st["queued"],"max_queue":st["max_queue"],"active":st["active"],"slots":st["slots"]}
+    try: free = shutil.disk_usage(CACHE_DIR).free
+    except OSError: free = 0
+    checks["disk"] = {"ok":free >= READY_MIN_FREE_BYTES,"free_bytes":free,"min_free_bytes":READY_MIN_FREE_BYTES}
+    dz = deezer_probe.stats()
+    checks["deezer"] = dict(dz, ok=bool(dz["ok"]) and dz["age_s"] <= READY_DEEZER_MAX_AGE, required=READY_REQUIRE_DEEZER)
+    ready = all(c["ok"] for n, c in checks.items() if n != "deezer" or READY_REQUIRE_DEEZER)
+    return ready, checks
+
+# ── Background threads ──
+# Nothing starts at import: a preloading gunicorn master would otherwise fork while these threads
+# hold locks (a worker inheriting a held AudioCache._evict_lock would never evict again). Each
+# process starts its own from gunicorn's post_fork hook, the ASGI lifespan startup, or its first request.
+_background_pid = None
+
+def start_background():
+    """yt-dlp detection, audio cache scan, trending refresher and Deezer probe for this process."""
+    global _background_pid
+    if _background_pid == os.getpid(): return
+    _background_pid = os.getpid()
+    if YTDLP_DETECT != "lazy": ytdlp_detector.start()
+    audio_cache.start(); trending_feed.start(); deezer_probe.start()
+
+@app.before_request
+def _start_background():
+    start_background()
+
 @app.route("/")
 def index():
-    return jsonify({"status":"SoundWave API running","ytdlp":YTDLP_CMD is not None})
+    return jsonify({"status":"SoundWave API running","ytdlp":ytdlp_cmd(wait=False) is not None})
+
+def health_status():
+    return {"status":"ok","ytdlp":ytdlp_cmd(wait=False) is not None,"ytdlp_ready":ytdlp_detector.done.is_set(),
+            "search_cache":search_cache.stats(),"yt_id_cache":yt_id_cache.stats(),
+            "track_cache":track_cache.stats(),"audio_cache":audio_cache.stats(),
+            "ytdlp_lanes":{n: l.stats() for n, l in LANES.items()},"yt_prefetch":yt_prefetcher.stats(),
+            "audio_prefetch":audio_prefetcher.stats()}
 
 @app.route("/api/health")
 def health():
-    return jsonify({"status":"ok","ytdlp":YTDLP_CMD is not None})
+    return jsonify(health_status())
+
+@app.route("/api/health/live")
+def health_live():
+    return jsonify({"status":"ok"})
+
+@app.route("/api/health/ready")
+def health_ready():
+    ready, checks = readiness()
+    return jsonify({"status":"ready" if ready else "not ready","checks":checks}), 200 if ready else 503
+
+CACHES = {"search":search_cache,"search_body":search_bodies,"yt_id":yt_id_cache,"track":track_cache,"audio":audio_cache}
+
+def per_cache(fn): return lambda: {(("cache",n),): fn(c) for n, c in CACHES.items()}
+
+def per_lane(key): return lambda: {(("lane",n),): l.stats()[key] for n, l in LANES.items()}
+
+metric(Gauge("soundwave_cache_hits_total", "Cache lookups answered from the cache.", per_cache(lambda c: c.hits), "counter"))
+metric(Gauge("soundwave_cache_misses_total", "Cache lookups that missed.", per_cache(lambda c: c.misses), "counter"))
+metric(Gauge("soundwave_cache_hit_ratio", "Hits over lookups since start.", per_cache(lambda c: round(c.hits/max(1, c.hits+c.misses), 4))))
+metric(Gauge("soundwave_cache_evictions_total", "Entries evicted for size.", per_cache(lambda c: getattr(c, "evictions", None)), "counter"))
+metric(Gauge("soundwave_cache_bytes", "Bytes held by each cache.", per_cache(lambda c: c.stats().get("bytes"))))
+metric(Gauge("soundwave_audio_cache_files", "MP3 files in the audio cache.", lambda: audio_cache.stats()["files"]))
+metric(Gauge("soundwave_audio_cache_quota_bytes", "Audio cache byte quota (0 = unlimited).", lambda: audio_cache.quota))
+metric(Gauge("soundwave_ytdlp_lane_active", "yt-dlp runs holding a lane slot.", per_lane("active")))
+metric(Gauge("soundwave_ytdlp_lane_slots", "Concurrent yt-dlp runs allowed per lane.", per_lane("slots")))
+metric(Gauge("soundwave_ytdlp_lane_queued", "yt-dlp runs waiting for a lane slot.", per_lane("queued")))
+metric(Gauge("soundwave_ytdlp_lane_rejected_total", "yt-dlp runs refused because the lane queue was full.", per_lane("rejected"), "counter"))
+metric(Gauge("soundwave_yt_prefetch_queued", "Search results waiting for a background yt_id lookup.", lambda: yt_prefetcher.stats()["queued"]))
+metric(Gauge("soundwave_yt_prefetch_resolved_total", "Background yt_id lookups run.", lambda: yt_prefetcher.resolved, "counter"))
+metric(Gauge("soundwave_yt_prefetch_dropped_total", "yt_id prefetches dropped because the queue was full.", lambda: yt_prefetcher.dropped, "counter"))
+metric(Gauge("soundwave_audio_prefetch_queued", "Speculative downloads waiting or running.", lambda: audio_prefetcher.queued))
+metric(Gauge("soundwave_audio_prefetch_downloaded_total", "Speculative downloads completed.", lambda: audio_prefetcher.downloaded, "counter"))
+metric(Gauge("soundwave_audio_prefetch_cancelled_total", "Speculative downloads dropped because the session moved on or the lane was busy.", lambda: audio_prefetcher.cancelled, "counter"))
+metric(Gauge(jobs_active.name, jobs_active.help, jobs_active.snapshot))
+
+@app.route("/metrics")
+def metrics():
+    return Response(render_metrics(), mimetype="text/plain; version=0.0.4")
 
 @app.route("/api/search")
 def search():
     query = request.args.get("q","").strip()
     limit = int(request.args.get("limit",20))
     if not query: return jsonify({"error":"No query"}),400
-    
-    key = f"{query}_{limit}"
-    if key in search_cache: return jsonify(search_cache[key])
-    
-    songs = deezer_search(query, limit)
-    resp = {"results": songs, "query": query}
-    if songs: search_cache[key] = resp
-    return jsonify(resp)
+    songs, songs_json = search_body(query, limit)
+    if PREFETCH_YT_IDS: yt_prefetcher.submit(s["yt_query"] for s in songs[:PREFETCH_YT_IDS])
+    return json_response(search_json(query, songs_json))
 
 @app.route("/api/yt_id")
 def yt_id_route():
@@ -110,21 +1486,105 @@ def yt_id_route():
     if vid: return jsonify({"yt_id": vid})
     return jsonify({"error":"Not found"}),404
 
+TRACKS_MAX = int(os.environ.get("TRACKS_MAX", 500))
+_tracks_pool = ThreadPoolExecutor(int(os.environ.get("TRACKS_WORKERS", 8)), thread_name_prefix="tracks")
+
+def tracks_ids(data):
+    """(ids, error) for a /api/tracks request: ids as strings, duplicates collapsed, order kept."""
+    ids = list(dict.fromkeys(str(i) for i in data.get("ids",[]) if str(i).strip()))
+    if not ids: return None, "No ids"
+    if len(ids) > TRACKS_MAX: return None, f"At most {TRACKS_MAX} ids"
+    return ids, None
+
+def tracks_response(ids, songs):
+    return {"tracks":[s for s in songs if s], "missing":[i for i, s in zip(ids, songs) if not s]}
+
+@app.route("/api/tracks", methods=["POST"])
+def tracks():
+    """Metadata for many Deezer ids: {"ids": [...]} -> {"tracks": [song...], "missing": [id...]},
+    in request order with duplicates collapsed."""
+    ids, error = tracks_ids(request.json or {})
+    if error: return jsonify({"error":error}),400
+    futures = [submit_traced(_tracks_pool, cached_track, i) for i in ids]
+    return jsonify(tracks_response(ids, [f.result() for f in futures]))
+
+YTID_BATCH_MAX = int(os.environ.get("YTID_BATCH_MAX", 100))
+YTID_BATCH_WORKERS = int(os.environ.get("YTID_BATCH_WORKERS", 8))
+_ytid_batch_pool = ThreadPoolExecutor(YTID_BATCH_WORKERS, thread_name_prefix="ytid-batch")
+
+def ytid_batch_plan(data):
+    """(groups, ready, error) for a batch request. groups maps (kind, key) to the request values
+    sharing that key, so identical queries (after normalization) resolve once; ready holds the
+    groups already answered by the cache."""
+    items = [("query", q) for q in data.get("queries",[]) if isinstance(q,str) and q.strip()]
+    items += [("deezer_id", str(i)) for i in data.get("deezer_ids",[]) if str(i).strip()]
+    if not items: return None, None, "No queries"
+    if len(items) > YTID_BATCH_MAX: return None, None, f"At most {YTID_BATCH_MAX} items"
+    groups, ready = {}, {}
+    for kind, v in items:
+        groups.setdefault((kind, normalize_query(v) if kind=="query" else v), []).append(v)
+    for (kind, key) in groups:
+        cached = yt_id_cache.get(key) if kind == "query" else None
+        if cached is not None: ready[(kind, key)] = cached or None
+    return groups, ready, None
+
+BUSY = object()  # result of a lookup that a saturated yt-dlp lane turned away; unlike None, worth a retry
+
+def ytid_batch_lines(groups, g, vid):
+    """NDJSON lines for one resolved group; lookups turned away carry "error": "busy"."""
+    result = {"yt_id": None, "error": "busy"} if vid is BUSY else {"yt_id": vid}
+    return b"".join(app.json.encode({g[0]: v, **result}) + b"\n" for v in dict.fromkeys(groups[g]))
+
+def ytid_batch_response(groups, results):
+    """(body, status). Lookups turned away are null in the body and also listed under "busy";
+    when that is every lookup the status is 503."""
+    resp, busy, statuses = {"queries": {}, "deezer_ids": {}}, {"queries": [], "deezer_ids": []}, set()
+    for g, vid in results:
+        field = "queries" if g[0]=="query" else "deezer_ids"
+        for v in groups[g]:
+            resp[field][v] = None if vid is BUSY else vid
+            if vid is BUSY: busy[field].append(v)
+        statuses.add(vid is BUSY)
+    if True in statuses: resp["busy"] = busy
+    return resp, 503 if statuses == {True} else 200
+
+def _resolve(kind, value):
+    try:
+        if kind == "query": return get_yt_id(value)
+        song = cached_track(value)
+        return get_yt_id(song["yt_query"]) if song else None
+    except Saturated: return BUSY
+
+@app.route("/api/yt_id/batch", methods=["POST"])
+def yt_id_batch():
+    """Resolve many tracks at once: {"queries": [yt_query...], "deezer_ids": [...], "stream": false}.
+    Returns {"queries": {q: yt_id|null}, "deezer_ids": {id: yt_id|null}}, plus "busy" listing the
+    lookups a full yt-dlp lane turned away, or with stream=true one NDJSON line per track as it resolves."""
+    data = request.json or {}
+    groups, ready, error = ytid_batch_plan(data)
+    if error: return jsonify({"error":error}),400
+    # cached groups never reach the pool
+    futures = {submit_traced(_ytid_batch_pool, _resolve, g[0], groups[g][0]): g for g in groups if g not in ready}
+
+    def results():
+        yield from ready.items()
+        for f in as_completed(futures):
+            try: vid = f.result()
+            except Exception: vid = None
+            yield futures[f], vid
+
+    if data.get("stream") or request.args.get("stream"):
+        return Response((ytid_batch_lines(groups, g, vid) for g, vid in results()), mimetype="application/x-ndjson")
+    resp, status = ytid_batch_response(groups, results())
+    return jsonify(resp), status, {"Retry-After": str(LANES["search"].retry_after)} if status == 503 else {}
+
 @app.route("/api/download/<video_id>")
 def download(video_id):
-    cache_file = CACHE_DIR / f"{video_id}.mp3"
-    if cache_file.exists() and cache_file.stat().st_size > 10000:
-        return send_file(cache_file,mimetype="audio/mpeg",as_attachment=True,download_name=f"{video_id}.mp3")
-    
-    output = str(CACHE_DIR/f"{video_id}.%(ext)s")
-    result = run_ytdlp([
-        f"https://www.youtube.com/watch?v={video_id}",
-        "-x","--audio-format","mp3","--audio-quality","192K",
-        "-o",output,"--no-playlist","--quiet","--no-warnings"
-    ], timeout=300)
-    
-    if cache_file.exists() and cache_file.stat().st_size > 10000:
-        return send_file(cache_file,mimetype="audio/mpeg",as_attachment=True,download_name=f"{video_id}.mp3")
+    audio_cache.count(cached_mp3(video_id) is not None)
+    cache_file = fetch_mp3(video_id)
+    if cache_file:
+        audio_cache.touch(video_id)
+        return serve_mp3(cache_file, video_id)
     
     # Fallback: redirect to stream
     r2 = run_ytdlp([f"https://www.youtube.com/watch?v={video_id}",
@@ -133,26 +1593,97 @@ def download(video_id):
         return redirect(r2.stdout.strip().split('\n')[0])
     return jsonify({"error":"Download failed"}),500
 
+@app.route("/api/stream/<video_id>")
+def stream(video_id):
+    """Like /api/download, but an uncached song starts playing while it is still being transcoded."""
+    cache_file = cached_mp3(video_id)
+    if cache_file:
+        audio_cache.count(True); audio_cache.touch(video_id)
+        return serve_mp3(cache_file, video_id)
+    if not (FFMPEG and ytdlp_cmd()): return download(video_id)
+    audio_cache.count(False); audio_prefetcher.preempt(video_id)
+    lane = LANES["download"]
+    lane.acquire(PRIORITY_HIGH, timeout=30)
+    rv = Response(stream_mp3(video_id), mimetype="audio/mpeg",
+                  headers={"Cache-Control":"no-store","X-Accel-Buffering":"no"})
+    rv.call_on_close(lane.release)  # the slot is held until the pipeline is done or the client leaves
+    return rv
+
+@app.route("/api/download/<video_id>", methods=["POST"])
+def download_job(video_id):
+    """Queue a download; poll status_url, then GET download_url once status is done."""
+    job = submit_download(video_id)
+    return jsonify(dict(job, status_url=f"/api/jobs/{job['job_id']}",
+                        download_url=f"/api/download/{video_id}")), 202
+
+def schedule_prefetch(data):
+    """(response, status) for a prefetch request; shared with asgi.py."""
+    if not isinstance(data, dict): return {"error":"session and tracks required"}, 400
+    session, tracks = str(data.get("session","")), data.get("tracks",[])
+    if not session or not isinstance(tracks, list): return {"error":"session and tracks required"}, 400
+    try:
+        ahead = max(0, min(int(data.get("ahead", PREFETCH_AUDIO_AHEAD)), PREFETCH_AUDIO_AHEAD))
+        start = max(0, int(data.get("position", -1)) + 1)
+    except (TypeError, ValueError): return {"error":"ahead and position must be integers"}, 400
+    queued = audio_prefetcher.schedule(session, tracks[start:start+ahead])
+    return {"session":session,"queued":len(queued)}, 202
+
+@app.route("/api/prefetch", methods=["POST"])
+def prefetch():
+    """Warm the audio cache ahead of playback:
+    {"session": id, "tracks": [song dict | yt_query...], "position": index now playing, "ahead": K}"""
+    resp, status = schedule_prefetch(request.json or {})
+    return jsonify(resp), status
+
+@app.route("/api/jobs/<job_id>")
+def job_status(job_id):
+    job = get_job(job_id)
+    if not job: return jsonify({"error":"Unknown job"}),404
+    return jsonify(job)
+
 @app.route("/api/trending")
 def trending():
-    songs = deezer_search("top hits 2024", 20)
-    if not songs: songs = deezer_search("popular songs", 20)
-    return jsonify({"trending": songs})
+    return json_response(trending_feed.body())
+
+PLAYLIST_MAX_SEEDS = int(os.environ.get("PLAYLIST_MAX_SEEDS", 10))
+PLAYLIST_SIZE = int(os.environ.get("PLAYLIST_SIZE", 24))
+PLAYLIST_DEADLINE = float(os.environ.get("PLAYLIST_DEADLINE", 8))     # seconds for the whole fan-out
+_fanout_pool = ThreadPoolExecutor(int(os.environ.get("FANOUT_WORKERS", 32)), thread_name_prefix="fanout")
+
+def playlist_seeds(seeds):
+    """Seed queries as strings (numbers are accepted as text, anything else is skipped), capped."""
+    if not isinstance(seeds, list): seeds = [seeds]
+    return [str(s) for s in seeds if isinstance(s, (str, int, float)) and not isinstance(s, bool)][:PLAYLIST_MAX_SEEDS]
+
+def playlist_response(data, results, partial):
+    """Playlist body from each seed's search results (in seed order). Seeds are interleaved
+    round-robin -- every seed's first song, then every second one... -- so each seed gets a
+    share of the PLAYLIST_SIZE slots however many there are; shared with asgi.py."""
+    seen, unique = set(), []
+    for s in itertools.chain.from_iterable(itertools.zip_longest(*results)):
+        if s is not None and s["id"] not in seen: seen.add(s["id"]); unique.append(s)
+    resp = {"playlist":unique[:PLAYLIST_SIZE]}
+    if partial: resp["partial"] = True
+    if data.get("session"):  # warm the tracks after the first; the client is about to fetch that one itself
+        audio_prefetcher.schedule(str(data["session"]), resp["playlist"][1:1+PREFETCH_AUDIO_AHEAD])
+    return resp
 
 @app.route("/api/playlist/generate", methods=["POST"])
 def playlist():
     data = request.json or {}
     seeds = data.get("seeds",[])
     if not seeds: return jsonify({"error":"No seeds"}),400
-    all_songs = []
-    for s in seeds[:3]:
-        all_songs.extend(deezer_search(s, 8))
-    seen,unique = set(),[]
-    for s in all_songs:
-        if s["id"] not in seen: seen.add(s["id"]); unique.append(s)
-    return jsonify({"playlist":unique[:24]})
+    # seed searches run concurrently; seeds that fail or miss the deadline are left out
+    futures = [submit_traced(_fanout_pool, cached_search, s, 8) for s in playlist_seeds(seeds)]
+    done, pending = wait(futures, timeout=PLAYLIST_DEADLINE)
+    results, failed = [], False
+    for f in futures:
+        if f in done and f.exception() is None: results.append(f.result())
+        elif f in done: failed = True; print(f"Playlist seed search failed: {f.exception()}")
+    return jsonify(playlist_response(data, results, bool(pending or failed)))
 
 if __name__ == "__main__":
     port = int(os.environ.get("PORT",5000))
     print(f"🎵 SoundWave on port {port}")
+    start_background()
     app.run(host="0.0.0.0",port=port,debug=False,threaded=True)
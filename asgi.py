@@ -0,0 +1,430 @@
+"""
+SoundWave Backend - ASGI entry point
+Same routes and JSON as app.py, but slow work waits in coroutines instead of OS threads:
+Deezer over an async keep-alive client, yt-dlp/ffmpeg via asyncio subprocesses, files streamed
+in chunks. Caches, the audio cache index, the trending feed and download jobs are shared with app.py.
+
+    WEB_CONCURRENCY=1 uvicorn asgi:app --host 0.0.0.0 --port $PORT   # one process: see YTDLP_DOWNLOAD_SLOTS
+"""
+
+import asyncio, os, re, time, urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+from email.utils import formatdate, parsedate_to_datetime
+import httpx
+from werkzeug.datastructures import Headers
+import app as sw
+
+CHUNK = 256*1024
+_http = None        # httpx.AsyncClient, created at lifespan startup
+_inflight = {}      # video_id -> asyncio.Task, single-flight for downloads on this event loop
+
+# ── Shared-cache I/O ──
+# SQLite calls (busy timeout of 5 s behind BEGIN IMMEDIATE) and Redis calls can block, so cache
+# reads and writes, the audio index and the job store are used from a small pool of their own.
+CACHE_IO_WORKERS = int(os.environ.get("CACHE_IO_WORKERS", 8))
+_cache_pool = ThreadPoolExecutor(CACHE_IO_WORKERS, thread_name_prefix="cache-io")
+
+async def off_loop(fn, *args):
+    """fn(*args) on the cache I/O pool, in this request's context so its spans are kept."""
+    return await asyncio.wrap_future(sw.submit_traced(_cache_pool, fn, *args))
+
+# ── Async Deezer / yt-dlp ──
+def _client():
+    global _http
+    if _http is None:
+        _http = httpx.AsyncClient(
+            base_url=sw.DEEZER_API, headers={"User-Agent":"Mozilla/5.0"},
+            limits=httpx.Limits(max_keepalive_connections=sw.DEEZER_POOL_SIZE),
+            timeout=httpx.Timeout(sw.DEEZER_READ_TIMEOUT, connect=sw.DEEZER_CONNECT_TIMEOUT))
+    return _http
+
+async def deezer_search(query, limit=20):
+    """Async deezer_search: same song dicts, [] on any failure."""
+    t0, outcome = time.perf_counter(), "error"
+    try:
+        with sw.span("deezer"): r = await _client().get("/search", params={"q":query,"limit":limit,"output":"json"})
+        r.raise_for_status()
+        outcome = "ok"
+        with sw.span("decode"): data = sw.json_loads(r.content).get('data', [])
+        return [sw.deezer_song(t) for t in data]
+    except Exception as e:
+        if isinstance(e, httpx.TimeoutException): outcome = "timeout"
+        print(f"Deezer search failed: {e}")
+        return []
+    finally:
+        sw.deezer_requests.inc(outcome=outcome); sw.deezer_latency.observe(time.perf_counter()-t0)
+        sw.deezer_probe.record(outcome == "ok", None if outcome == "ok" else outcome)
+
+async def cached_search(query, limit=20):
+    songs = await off_loop(sw.search_cached, query, limit)
+    if songs is None:
+        songs = await deezer_search(query, limit); await off_loop(sw.search_store, query, limit, songs)
+    return songs
+
+async def search_body(query, limit=20):
+    """Async sw.search_body, sharing its per-process cache of encoded results."""
+    return (sw.search_bodies.get(sw.search_key(query, limit))
+            or sw.encode_search_body(query, limit, await cached_search(query, limit)))
+
+async def run_ytdlp(args, timeout=120, lane="search", priority=sw.PRIORITY_HIGH):
+    """Async run_ytdlp with the same returncode/stdout/stderr contract and the same scheduler lanes."""
+    with sw.span("ytdlp_wait"): waited = await sw.LANES[lane].acquire_async(priority, timeout)
+    t0 = time.perf_counter()
+    try:
+        with sw.span("ytdlp"): result = await _run_ytdlp(args, timeout-waited)
+    finally: sw.LANES[lane].release()
+    sw.observe_ytdlp(sw.ytdlp_op(args, lane), time.perf_counter()-t0, result)
+    return result
+
+async def ytdlp_cmd():
+    """sw.ytdlp_cmd() without blocking the event loop while detection is still running."""
+    if sw.ytdlp_detector.done.is_set(): return sw.ytdlp_detector.cmd
+    return await asyncio.to_thread(sw.ytdlp_cmd)
+
+async def _run_ytdlp(args, timeout):
+    if sw.YTDLP_MODE == "inprocess" and sw.yt_dlp:
+        try: return await asyncio.wait_for(asyncio.wrap_future(sw._ydl_pool.submit(sw._ydl_run, args)), timeout)
+        except asyncio.TimeoutError: return sw.YtdlpResult(1, "", "timeout")
+    cmd = await ytdlp_cmd()
+    if not cmd: return sw.YtdlpResult(1, "", "not found")
+    p = await asyncio.create_subprocess_exec(*cmd, *args,
+                                             stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+    try: out, err = await asyncio.wait_for(p.communicate(), timeout)
+    except asyncio.TimeoutError:
+        p.kill(); await p.wait()
+        return sw.YtdlpResult(1, "", "timeout")
+    return sw.YtdlpResult(p.returncode, out.decode(errors="replace"), err.decode(errors="replace"))
+
+async def get_yt_id(query):
+    key, cached = await off_loop(sw.cached_yt_id, query)
+    if cached is not None: return cached or None
+    try: return await off_loop(sw.ytid_from_result, key, await run_ytdlp(sw.ytid_args(query), timeout=40))
+    except sw.Saturated: raise
+    except Exception: return None
+
+async def fetch_mp3(video_id):
+    """Async fetch_mp3: concurrent requests for one id await the same download task."""
+    f = sw.cached_mp3(video_id)
+    if f: return f
+    sw.audio_prefetcher.preempt(video_id)
+    task = _inflight.get(video_id)
+    if task is None:
+        task = _inflight[video_id] = asyncio.ensure_future(_download_mp3(video_id))
+        task.add_done_callback(lambda t: _inflight.pop(video_id, None))
+    return await asyncio.shield(task)
+
+async def _download_mp3(video_id):
+    if sw.cached_mp3(video_id): return sw.cached_mp3(video_id)
+    tmp = f"{sw.temp_name(video_id)}-{id(asyncio.current_task())}"
+    try:
+        await run_ytdlp(sw.mp3_args(video_id, tmp), timeout=300, lane="download")
+        return await off_loop(sw.commit_mp3, video_id, sw.CACHE_DIR/f"{tmp}.mp3")
+    finally: sw.remove_temp(tmp)
+
+# ── Responses ──
+def _cors(headers):
+    return [(b"access-control-allow-origin", b"*"),
+            (b"access-control-expose-headers", b"Accept-Ranges, Content-Length, Content-Range, ETag, Server-Timing, X-Request-ID")] + headers
+
+async def send_json(send, obj, status=200, headers=()):
+    await send_json_body(send, sw.app.json.encode(obj), status, headers)
+
+async def send_json_body(send, body, status=200, headers=()):
+    """Send JSON that is already encoded (app.json.encode, or bytes cached by app.py)."""
+    body += b"\n"
+    await send({"type":"http.response.start","status":status,"headers":_cors([
+        (b"content-type", b"application/json"), (b"content-length", str(len(body)).encode()), *headers])})
+    await send({"type":"http.response.body","body":body})
+
+async def send_empty(send, status, headers=()):
+    await send({"type":"http.response.start","status":status,"headers":_cors(list(headers))})
+    await send({"type":"http.response.body","body":b""})
+
+async def send_mp3(req, send, path, video_id):
+    """Async serve_mp3: single byte ranges, ETag/Last-Modified validators, immutable caching."""
+    st = path.stat()
+    etag = f'"{sw.mp3_etag(video_id, st)}"'
+    base = [(b"etag", etag.encode()), (b"last-modified", formatdate(int(st.st_mtime), usegmt=True).encode()),
+            (b"cache-control", f"public, max-age={sw.AUDIO_MAX_AGE}, immutable".encode()),
+            (b"accept-ranges", b"bytes")]
+    if _not_modified(req, etag, st.st_mtime): return await send_empty(send, 304, base)
+    start, end, status = 0, st.st_size-1, 200
+    rng = req.headers.get("range")
+    if rng and req.headers.get("if-range", etag) == etag:
+        m = re.fullmatch(r"bytes=(\d*)-(\d*)", rng.strip())
+        if m and m.group(1): start, end = int(m.group(1)), min(int(m.group(2) or end), end)
+        elif m and m.group(2): start = max(0, st.st_size-int(m.group(2)))
+        if not m or not (m.group(1) or m.group(2)) or start > end:
+            return await send_empty(send, 416, [(b"content-range", f"bytes */{st.st_size}".encode())])
+        status = 206
+        base.append((b"content-range", f"bytes {start}-{end}/{st.st_size}".encode()))
+    await send({"type":"http.response.start","status":status,"headers":_cors(base+[
+        (b"content-type", b"audio/mpeg"), (b"content-length", str(end-start+1).encode()),
+        (b"content-disposition", f"attachment; filename={video_id}.mp3".encode())])})
+    if req.method == "HEAD": return await send({"type":"http.response.body","body":b""})
+    with open(path, "rb") as f:
+        f.seek(start)
+        left = end-start+1
+        while left > 0:
+            data = await asyncio.to_thread(f.read, min(CHUNK, left))
+            if not data: break
+            left -= len(data)
+            await send({"type":"http.response.body","body":data,"more_body":left > 0})
+
+def _not_modified(req, etag, mtime):
+    inm = req.headers.get("if-none-match")
+    if inm: return inm.strip() == "*" or etag in [t.strip() for t in inm.split(",")]
+    ims = req.headers.get("if-modified-since")
+    try: return bool(ims) and int(mtime) <= parsedate_to_datetime(ims).timestamp()
+    except (TypeError, ValueError): return False
+
+async def stream_mp3(send, video_id):
+    """Async stream_mp3: yt-dlp piped through ffmpeg, chunks sent as produced and teed into the cache."""
+    yt_cmd, ff_cmd = sw.pipe_cmds(video_id)
+    r, w = os.pipe()
+    yt = await asyncio.create_subprocess_exec(*yt_cmd, stdout=w, stderr=asyncio.subprocess.DEVNULL)
+    ff = await asyncio.create_subprocess_exec(*ff_cmd, stdin=r, stdout=asyncio.subprocess.PIPE,
+                                              stderr=asyncio.subprocess.DEVNULL)
+    os.close(r); os.close(w)
+    tmp = f"{sw.temp_name(video_id)}-{id(asyncio.current_task())}"
+    t0, complete = time.perf_counter(), False
+    deadline = time.monotonic()+300
+    await send({"type":"http.response.start","status":200,"headers":_cors([
+        (b"content-type", b"audio/mpeg"), (b"cache-control", b"no-store")])})
+    try:
+        with open(sw.CACHE_DIR/f"{tmp}.mp3", "wb") as f:
+            while True:
+                data = await asyncio.wait_for(ff.stdout.read(CHUNK), max(0, deadline-time.monotonic()))
+                if not data: break
+                f.write(data)
+                await send({"type":"http.response.body","body":data,"more_body":True})
+        complete = await ff.wait() == 0 and await yt.wait() == 0
+        if complete: await off_loop(sw.commit_mp3, video_id, sw.CACHE_DIR/f"{tmp}.mp3")
+        await send({"type":"http.response.body","body":b""})
+    finally:  # client disconnects surface as errors from send()
+        for p in (yt, ff):
+            if p.returncode is None: p.kill()
+        await ff.wait(); await yt.wait()
+        sw.remove_temp(tmp)
+        timed_out = not complete and time.monotonic() >= deadline
+        sw.observe_ytdlp("stream", time.perf_counter()-t0, sw.YtdlpResult(0 if complete else 1, "", "timeout" if timed_out else ""))
+
+# ── Routes ──
+class Request:
+    def __init__(self, scope, body):
+        self.method, self.path = scope["method"], scope["path"]
+        self.args = {k: v[0] for k, v in urllib.parse.parse_qs(scope["query_string"].decode()).items()}
+        self.headers = {k.decode().lower(): v.decode() for k, v in scope["headers"]}
+        self.body = body
+
+    def json(self):
+        try: return sw.json_loads(self.body or b"null")
+        except ValueError: return None
+
+async def index(req, send):
+    await send_json(send, {"status":"SoundWave API running","ytdlp":sw.ytdlp_cmd(wait=False) is not None})
+
+async def health(req, send):
+    await send_json(send, await off_loop(sw.health_status))
+
+async def health_live(req, send):
+    await send_json(send, {"status":"ok"})
+
+async def health_ready(req, send):
+    ready, checks = sw.readiness()
+    await send_json(send, {"status":"ready" if ready else "not ready","checks":checks}, 200 if ready else 503)
+
+async def metrics(req, send):
+    await send({"type":"http.response.start","status":200,
+                "headers":_cors([(b"content-type", b"text/plain; version=0.0.4; charset=utf-8")])})
+    await send({"type":"http.response.body","body":(await off_loop(sw.render_metrics)).encode()})
+
+async def search(req, send):
+    query = req.args.get("q","").strip()
+    limit = int(req.args.get("limit",20))
+    if not query: return await send_json(send, {"error":"No query"}, 400)
+    songs, songs_json = await search_body(query, limit)
+    if sw.PREFETCH_YT_IDS: sw.yt_prefetcher.submit(s["yt_query"] for s in songs[:sw.PREFETCH_YT_IDS])
+    await send_json_body(send, sw.search_json(query, songs_json))
+
+async def yt_id_route(req, send):
+    query = req.args.get("q","").strip()
+    if not query: return await send_json(send, {"error":"No query"}, 400)
+    vid = await get_yt_id(query)
+    if vid: return await send_json(send, {"yt_id": vid})
+    await send_json(send, {"error":"Not found"}, 404)
+
+async def tracks(req, send):
+    ids, error = sw.tracks_ids(req.json() or {})
+    if error: return await send_json(send, {"error":error}, 400)
+    # on app.py's pool, so a big batch can't take every to_thread worker
+    songs = await asyncio.gather(*(asyncio.wrap_future(sw.submit_traced(sw._tracks_pool, sw.cached_track, i)) for i in ids))
+    await send_json(send, sw.tracks_response(ids, songs))
+
+async def _resolve(kind, value, limit):
+    """Async sw._resolve; at most YTID_BATCH_WORKERS lookups of one batch run at a time."""
+    async with limit:
+        try:
+            if kind == "query": return await get_yt_id(value)
+            song = await asyncio.wrap_future(sw.submit_traced(sw._tracks_pool, sw.cached_track, value))
+            return await get_yt_id(song["yt_query"]) if song else None
+        except sw.Saturated: return sw.BUSY
+        except Exception: return None
+
+async def yt_id_batch(req, send):
+    data = req.json() or {}
+    groups, ready, error = await off_loop(sw.ytid_batch_plan, data)
+    if error: return await send_json(send, {"error":error}, 400)
+    limit = asyncio.Semaphore(sw.YTID_BATCH_WORKERS)
+    async def resolve(g): return g, await _resolve(g[0], groups[g][0], limit)
+    tasks = [asyncio.ensure_future(resolve(g)) for g in groups if g not in ready]
+    try:
+        if not (data.get("stream") or req.args.get("stream")):
+            resp, status = sw.ytid_batch_response(groups, [*ready.items(), *await asyncio.gather(*tasks)])
+            return await send_json(send, resp, status,
+                                   [(b"retry-after", str(sw.LANES["search"].retry_after).encode())] if status == 503 else [])
+        await send({"type":"http.response.start","status":200,"headers":_cors([(b"content-type", b"application/x-ndjson")])})
+        for g, vid in ready.items():
+            await send({"type":"http.response.body","body":sw.ytid_batch_lines(groups, g, vid),"more_body":True})
+        for t in asyncio.as_completed(tasks):
+            g, vid = await t
+            await send({"type":"http.response.body","body":sw.ytid_batch_lines(groups, g, vid),"more_body":True})
+        await send({"type":"http.response.body","body":b""})
+    finally:  # client gone: stop lookups nobody will read
+        for t in tasks: t.cancel()
+
+async def download(req, send, video_id):
+    sw.audio_cache.count(sw.cached_mp3(video_id) is not None)
+    cache_file = await fetch_mp3(video_id)
+    if cache_file:
+        await off_loop(sw.audio_cache.touch, video_id)
+        return await send_mp3(req, send, cache_file, video_id)
+    # Fallback: redirect to stream
+    r2 = await run_ytdlp([f"https://www.youtube.com/watch?v={video_id}",
+        "--get-url","-f","bestaudio/best","--no-playlist","--quiet"],timeout=60)
+    if r2.returncode==0 and r2.stdout.strip():
+        return await send_empty(send, 302, [(b"location", r2.stdout.strip().split('\n')[0].encode())])
+    await send_json(send, {"error":"Download failed"}, 500)
+
+async def stream(req, send, video_id):
+    cache_file = sw.cached_mp3(video_id)
+    if cache_file:
+        sw.audio_cache.count(True); await off_loop(sw.audio_cache.touch, video_id)
+        return await send_mp3(req, send, cache_file, video_id)
+    if not (sw.FFMPEG and await ytdlp_cmd()): return await download(req, send, video_id)
+    sw.audio_cache.count(False); sw.audio_prefetcher.preempt(video_id)
+    lane = sw.LANES["download"]
+    await lane.acquire_async(sw.PRIORITY_HIGH, 30)
+    try: await stream_mp3(send, video_id)
+    finally: lane.release()
+
+async def download_job(req, send, video_id):
+    job = await off_loop(sw.submit_download, video_id)
+    await send_json(send, dict(job, status_url=f"/api/jobs/{job['job_id']}",
+                               download_url=f"/api/download/{video_id}"), 202)
+
+async def job_status(req, send, job_id):
+    job = await off_loop(sw.get_job, job_id)
+    if not job: return await send_json(send, {"error":"Unknown job"}, 404)
+    await send_json(send, job)
+
+async def trending(req, send):
+    feed = sw.trending_feed
+    body = feed.body() if feed.songs is not None else await asyncio.to_thread(feed.body)  # body() may wait for the first build
+    await send_json_body(send, body)
+
+async def playlist(req, send):
+    data = req.json() or {}
+    seeds = data.get("seeds",[])
+    if not seeds: return await send_json(send, {"error":"No seeds"}, 400)
+    tasks = [asyncio.ensure_future(cached_search(s, 8)) for s in sw.playlist_seeds(seeds)]
+    done, pending = await asyncio.wait(tasks, timeout=sw.PLAYLIST_DEADLINE) if tasks else (set(), set())
+    for t in pending: t.cancel()
+    results, failed = [], False
+    for t in tasks:
+        if t in done and t.exception() is None: results.append(t.result())
+        elif t in done: failed = True; print(f"Playlist seed search failed: {t.exception()}")
+    await send_json(send, sw.playlist_response(data, results, bool(pending or failed)))
+
+async def prefetch(req, send):
+    resp, status = sw.schedule_prefetch(req.json() or {})
+    await send_json(send, resp, status)
+
+# Flask rule syntax, so /metrics labels routes the same way under either server
+ROUTES = [(m, rule, re.compile(re.sub(r"<\w+>", "([^/]+)", rule)), h) for m, rule, h in [
+    ("GET",  "/", index),
+    ("GET",  "/metrics", metrics),
+    ("GET",  "/api/health", health),
+    ("GET",  "/api/health/live", health_live),
+    ("GET",  "/api/health/ready", health_ready),
+    ("GET",  "/api/search", search),
+    ("GET",  "/api/yt_id", yt_id_route),
+    ("POST", "/api/yt_id/batch", yt_id_batch),
+    ("POST", "/api/tracks", tracks),
+    ("GET",  "/api/download/<video_id>", download),
+    ("POST", "/api/download/<video_id>", download_job),
+    ("GET",  "/api/stream/<video_id>", stream),
+    ("GET",  "/api/jobs/<job_id>", job_status),
+    ("GET",  "/api/trending", trending),
+    ("POST", "/api/playlist/generate", playlist),
+    ("POST", "/api/prefetch", prefetch),
+]]
+
+async def app(scope, receive, send):
+    if scope["type"] == "lifespan":
+        while True:
+            msg = await receive()
+            if msg["type"] == "lifespan.startup":
+                sw.start_background()
+                await send({"type":"lifespan.startup.complete"})
+            elif msg["type"] == "lifespan.shutdown":
+                if _http: await _http.aclose()
+                return await send({"type":"lifespan.shutdown.complete"})
+    if scope["type"] != "http": return
+    sw.start_background()  # no-op once started; covers servers run without lifespan events
+    t0, route, status = time.perf_counter(), [], []
+    headers = Headers([(k.decode("latin-1"), v.decode("latin-1")) for k, v in scope["headers"]])
+    rid = sw.request_id(headers)
+    spans = [] if sw.trace_wanted(headers) else None
+    sw._trace.set(spans)  # this task's context, inherited by asyncio.to_thread calls
+    async def timed_send(msg):
+        if msg["type"] == "http.response.start":  # latency up to the response head, as app.py measures it
+            label, elapsed = route[0] if route else "unmatched", time.perf_counter()-t0
+            sw.http_requests.inc(route=label, method=scope["method"], status=msg["status"])
+            sw.http_latency.observe(elapsed, route=label)
+            extra = [(b"x-request-id", rid.encode())]
+            if spans is not None:
+                extra += [(b"server-timing", sw.server_timing(spans, elapsed).encode()), (b"timing-allow-origin", b"*")]
+            msg = dict(msg, headers=[*msg["headers"], *extra]); status.append(msg["status"])
+        elif spans is not None and sw.TRACE_LOG and not msg.get("more_body"):
+            sw.trace_log(rid, scope["method"], scope["path"], status[0], spans, time.perf_counter()-t0)
+        await send(msg)
+    sw.http_inflight.inc()
+    try: await dispatch(scope, receive, timed_send, route)
+    finally: sw.http_inflight.inc(-1)
+
+async def dispatch(scope, receive, send, route):
+    body = b""
+    while True:
+        msg = await receive()
+        body += msg.get("body", b"")
+        if not msg.get("more_body"): break
+    req = Request(scope, body)
+    if req.method == "OPTIONS":  # CORS preflight, as flask-cors answers it
+        return await send_empty(send, 200, [
+            (b"access-control-allow-methods", b"GET, HEAD, POST, OPTIONS"),
+            (b"access-control-allow-headers", req.headers.get("access-control-request-headers","*").encode())])
+    allowed = False
+    for method, rule, pattern, handler in ROUTES:
+        m = pattern.fullmatch(req.path)
+        if not m: continue
+        allowed = True
+        if method == req.method or (method == "GET" and req.method == "HEAD"):
+            route.append(rule)
+            if "<video_id>" in rule and not sw.VIDEO_ID_RE.fullmatch(m.group(1)):
+                return await send_json(send, {"error":"Invalid video id"}, 400)
+            try: return await handler(req, send, *m.groups())  # scope["path"] is already percent-decoded
+            except sw.Saturated as e:
+                return await send_json(send, {"error":"Busy, retry later","lane":e.lane}, 503,
+                                       [(b"retry-after", str(e.retry_after).encode())])
+    await send_json(send, {"error":"Method not allowed" if allowed else "Not found"}, 405 if allowed else 404)
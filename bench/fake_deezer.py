@@ -0,0 +1,55 @@
+"""
+Local stand-in for api.deezer.com: canned /search, /chart/0/tracks and /track/<id> payloads,
+each answered after a configurable delay.
+
+    python bench/fake_deezer.py --port 8766 --latency 80 --jitter 20
+"""
+
+import argparse, json, random, time, zlib
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs
+
+def track(i):
+    return {"id":i,"title":f"Song {i}","duration":150+i%120,"preview":f"https://cdn.example/preview/{i}.mp3",
+            "artist":{"id":i%500,"name":f"Artist {i%500}"},
+            "album":{"id":i%2000,"title":f"Album {i%2000}","cover_medium":f"https://cdn.example/cover/{i%2000}.jpg"}}
+
+def tracks(seed, n):
+    """The same query always returns the same tracks, so caches behave as they would against Deezer."""
+    base = zlib.crc32(seed.encode()) % 10**6
+    return [track(base+k) for k in range(n)]
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive, like the real API
+
+    def do_GET(self):
+        u = urlsplit(self.path); q = {k: v[0] for k, v in parse_qs(u.query).items()}
+        time.sleep(max(0, random.gauss(self.server.latency, self.server.jitter))/1000)
+        if u.path == "/search":
+            body = {"data":tracks(q.get("q",""), int(q.get("limit",25))),"total":1000}
+        elif u.path.startswith("/chart/"):
+            body = {"data":tracks("chart", int(q.get("limit",25))),"total":100}
+        elif u.path.startswith("/track/") and u.path[7:].isdigit():
+            body = track(int(u.path[7:]))
+        else:
+            body = {"error":{"type":"DataException","message":"no data","code":800}}
+        data = json.dumps(body).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json"); self.send_header("Content-Length", str(len(data)))
+        self.end_headers(); self.wfile.write(data)
+
+    def log_message(self, *args): pass
+
+def main():
+    p = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    p.add_argument("--port", type=int, default=8766)
+    p.add_argument("--latency", type=float, default=80, help="mean response delay, ms")
+    p.add_argument("--jitter", type=float, default=20, help="delay standard deviation, ms")
+    a = p.parse_args()
+    server = ThreadingHTTPServer(("127.0.0.1", a.port), Handler)
+    server.daemon_threads, server.latency, server.jitter = True, a.latency, a.jitter
+    print(f"fake Deezer on http://127.0.0.1:{a.port} ({a.latency}±{a.jitter} ms)", flush=True)
+    server.serve_forever()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,45 @@
+#!/usr/bin/env python3
+"""
+Stand-in for the yt-dlp executable. Understands the invocations app.py makes:
+    ytsearch1:<query> --dump-json        -> one JSON line with a stable 11-char id
+    <url> --get-url                      -> a fake media URL
+    <url> -x --audio-format mp3 -o <tmpl> -> writes a FAKE_YTDLP_MP3_BYTES file at <tmpl> (ext = mp3),
+                                            printing progress lines with --newline --progress
+    <url> -o -                           -> writes FAKE_YTDLP_MP3_BYTES to stdout
+    --version
+Timings come from FAKE_YTDLP_SEARCH_MS / FAKE_YTDLP_DOWNLOAD_MS. Use it with
+    YTDLP_MODE=subprocess YTDLP_CMD="python bench/fake_ytdlp.py"
+"""
+
+import hashlib, json, os, sys, time
+
+SEARCH_MS = float(os.environ.get("FAKE_YTDLP_SEARCH_MS", 400))
+DOWNLOAD_MS = float(os.environ.get("FAKE_YTDLP_DOWNLOAD_MS", 2000))
+MP3_BYTES = int(os.environ.get("FAKE_YTDLP_MP3_BYTES", 64*1024))   # app.py rejects files <= 10000 bytes
+
+def video_id(s):
+    return hashlib.sha1(s.encode()).hexdigest()[:11]
+
+def main(args):
+    if "--version" in args: return print("2099.01.01")
+    target = next((a for a in args if not a.startswith("-")), "")
+    if target.startswith("ytsearch"):
+        time.sleep(SEARCH_MS/1000)
+        query = target.split(":", 1)[1]
+        return print(json.dumps({"id":video_id(query),"title":query,"duration":200}))
+    if "--get-url" in args:
+        time.sleep(SEARCH_MS/1000)
+        return print(f"https://media.example/{target[-11:]}.webm")
+    out = args[args.index("-o")+1] if "-o" in args else "-"
+    if "--progress" in args and out != "-":  # --newline progress lines, as app.py asks for with a callback
+        for i in range(10):
+            time.sleep(DOWNLOAD_MS/10000)
+            print(f"[download] {10*(i+1):5.1f}% of {MP3_BYTES/2**20:.2f}MiB", flush=True)
+    else: time.sleep(DOWNLOAD_MS/1000)
+    data = b"\xff\xfb\x90\x00" + os.urandom(MP3_BYTES-4)
+    if out == "-": sys.stdout.buffer.write(data)
+    else:
+        with open(out.replace("%(ext)s", "mp3"), "wb") as f: f.write(data)
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
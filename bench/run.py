@@ -0,0 +1,167 @@
+"""
+Offline load test: starts bench/fake_deezer.py and the server (with bench/fake_ytdlp.py as
+yt-dlp) in a scratch directory, drives each scenario with keep-alive clients and reports
+throughput, latency percentiles and the server's memory.
+
+    python bench/run.py                                   # all scenarios, gunicorn
+    python bench/run.py -s search yt_id -c 32 -d 20 --server uvicorn --json out.json
+"""
+
+import argparse, http.client, itertools, json, os, shutil, socket, subprocess, sys, tempfile, threading, time
+from pathlib import Path
+
+BENCH = Path(__file__).resolve().parent
+ROOT = BENCH.parent
+
+SCENARIOS = {  # name -> request i -> (method, path, JSON body or None)
+    "search":   lambda i, k: ("GET", f"/api/search?q=bench+query+{i%k}", None),
+    "trending": lambda i, k: ("GET", "/api/trending", None),
+    "playlist": lambda i, k: ("POST", "/api/playlist/generate",
+                              {"seeds":[f"seed {(i+j)%k}" for j in range(3)]}),
+    "yt_id":    lambda i, k: ("GET", f"/api/yt_id?q=bench+song+{i%k}", None),
+    "download": lambda i, k: ("GET", f"/api/download/bench{i%k:06d}", None),
+}
+
+def rss_bytes(pid):
+    """Resident memory of pid and all its descendants (Linux /proc), or None elsewhere."""
+    total, todo = 0, [pid]
+    try:
+        while todo:
+            p = todo.pop()
+            for line in open(f"/proc/{p}/status"):
+                if line.startswith("VmRSS:"): total += int(line.split()[1])*1024
+            for task in os.listdir(f"/proc/{p}/task"):
+                todo += [int(c) for c in open(f"/proc/{p}/task/{task}/children").read().split()]
+    except (OSError, ValueError):
+        return total or None
+    return total
+
+def percentile(sorted_values, q):
+    if not sorted_values: return 0.0
+    return sorted_values[min(len(sorted_values)-1, int(q*len(sorted_values)))]
+
+def port_open(port):
+    try: socket.create_connection(("127.0.0.1", port), timeout=0.5).close(); return True
+    except OSError: return False
+
+def wait_listening(proc, port, timeout=10):
+    """True once proc accepts connections on port; False if it exits first (e.g. the bind failed)."""
+    deadline = time.time()+timeout
+    while time.time() < deadline and proc.poll() is None:
+        if port_open(port): return True
+        time.sleep(0.1)
+    return False
+
+def wait_ready(port, timeout=60):
+    deadline = time.time()+timeout
+    while time.time() < deadline:
+        try:
+            c = http.client.HTTPConnection("127.0.0.1", port, timeout=2)
+            c.request("GET", "/api/health")
+            if c.getresponse().status == 200: return True
+        except OSError: pass
+        time.sleep(0.2)
+    return False
+
+def run_scenario(name, port, concurrency, duration, keys, server_pid):
+    make, counter = SCENARIOS[name], itertools.count()
+    latencies, errors, lock = [], [0], threading.Lock()
+    deadline = time.perf_counter()+duration
+    peak = [rss_bytes(server_pid)]
+
+    def client():
+        conn = http.client.HTTPConnection("127.0.0.1", port, timeout=120)
+        mine, failed = [], 0
+        while time.perf_counter() < deadline:
+            method, path, body = make(next(counter), keys)
+            data = json.dumps(body).encode() if body is not None else None
+            t0 = time.perf_counter()
+            for attempt in (0, 1):  # like a browser, retry once when a kept-alive connection was dropped
+                try:
+                    conn.request(method, path, body=data, headers={"Content-Type":"application/json"} if data else {})
+                    r = conn.getresponse(); r.read()
+                    if r.status >= 400: failed += 1
+                    if r.will_close: conn.close()
+                    break
+                except (OSError, http.client.HTTPException):
+                    conn.close()
+                    if attempt: failed += 1
+            mine.append(time.perf_counter()-t0)
+        with lock: latencies.extend(mine); errors[0] += failed
+
+    def sample_memory():
+        while time.perf_counter() < deadline:
+            peak[0] = max(peak[0] or 0, rss_bytes(server_pid) or 0) or None
+            time.sleep(0.5)
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=client) for _ in range(concurrency)]
+    threads.append(threading.Thread(target=sample_memory, daemon=True))
+    for t in threads: t.start()
+    for t in threads[:-1]: t.join()
+    elapsed = time.perf_counter()-start
+    latencies.sort()
+    return {"scenario":name,"requests":len(latencies),"errors":errors[0],
+            "rps":round(len(latencies)/elapsed, 1),
+            "p50_ms":round(1000*percentile(latencies, .50), 1),
+            "p95_ms":round(1000*percentile(latencies, .95), 1),
+            "p99_ms":round(1000*percentile(latencies, .99), 1),
+            "rss_mb":round(peak[0]/2**20, 1) if peak[0] else None}
+
+def main():
+    p = argparse.ArgumentParser(description="SoundWave offline benchmark")
+    p.add_argument("-s", "--scenarios", nargs="+", choices=list(SCENARIOS), default=list(SCENARIOS))
+    p.add_argument("-c", "--concurrency", type=int, default=16)
+    p.add_argument("-d", "--duration", type=float, default=10, help="seconds per scenario")
+    p.add_argument("-k", "--keys", type=int, default=50, help="distinct queries / video ids per scenario")
+    p.add_argument("--server", default="gunicorn", help="SERVER for wsgi.py (gunicorn, uvicorn, waitress, dev)")
+    p.add_argument("--workers", type=int, default=2, help="WEB_CONCURRENCY")
+    p.add_argument("--port", type=int, default=5055)
+    p.add_argument("--deezer-port", type=int, default=8766)
+    p.add_argument("--deezer-latency", type=float, default=80, help="ms")
+    p.add_argument("--deezer-jitter", type=float, default=20, help="ms")
+    p.add_argument("--search-ms", type=float, default=400, help="fake yt-dlp search time")
+    p.add_argument("--download-ms", type=float, default=2000, help="fake yt-dlp download time")
+    p.add_argument("--json", help="also write results to this file")
+    a = p.parse_args()
+
+    # whatever already listens on these ports would be benchmarked instead
+    for port in (a.port, a.deezer_port):
+        if port_open(port): sys.exit(f"port {port} is already in use")
+    workdir = tempfile.mkdtemp(prefix="soundwave-bench-")  # fresh audio_cache/ and cache.db
+    env = dict(os.environ, PORT=str(a.port), SERVER=a.server, WEB_CONCURRENCY=str(a.workers),
+               DEEZER_API=f"http://127.0.0.1:{a.deezer_port}", YTDLP_MODE="subprocess",
+               YTDLP_CMD=f"{sys.executable} {BENCH/'fake_ytdlp.py'}",
+               FAKE_YTDLP_SEARCH_MS=str(a.search_ms), FAKE_YTDLP_DOWNLOAD_MS=str(a.download_ms),
+               PYTHONPATH=str(ROOT), PYTHONUNBUFFERED="1")
+    log = open(Path(workdir)/"server.log", "w")
+    deezer = subprocess.Popen([sys.executable, BENCH/"fake_deezer.py", "--port", str(a.deezer_port),
+                               "--latency", str(a.deezer_latency), "--jitter", str(a.deezer_jitter)],
+                              stdout=log, stderr=log)
+    if not wait_listening(deezer, a.deezer_port):
+        deezer.kill(); deezer.wait(); log.close()
+        log_tail = (Path(workdir)/"server.log").read_text()[-3000:]
+        shutil.rmtree(workdir, ignore_errors=True)
+        sys.exit(f"fake Deezer did not start on port {a.deezer_port}:\n{log_tail}")
+    server = subprocess.Popen([sys.executable, ROOT/"wsgi.py"], cwd=workdir, env=env, stdout=log, stderr=log)
+    try:
+        if not wait_ready(a.port):
+            log.flush(); sys.exit(f"server did not become ready:\n{(Path(workdir)/'server.log').read_text()[-3000:]}")
+        print(f"{a.server} x{a.workers}, {a.concurrency} clients, {a.duration:g}s per scenario "
+              f"(Deezer {a.deezer_latency:g}±{a.deezer_jitter:g} ms, yt-dlp {a.search_ms:g}/{a.download_ms:g} ms)")
+        print(f"{'scenario':<10}{'requests':>10}{'errors':>8}{'rps':>9}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'rss MB':>9}")
+        results = []
+        for name in a.scenarios:
+            r = run_scenario(name, a.port, a.concurrency, a.duration, a.keys, server.pid)
+            results.append(r)
+            print(f"{name:<10}{r['requests']:>10}{r['errors']:>8}{r['rps']:>9}{r['p50_ms']:>9}"
+                  f"{r['p95_ms']:>9}{r['p99_ms']:>9}{r['rss_mb'] or '-':>9}", flush=True)
+        if a.json:
+            with open(a.json, "w") as f: json.dump({"args":vars(a),"results":results}, f, indent=2)
+    finally:
+        server.terminate(); deezer.terminate()
+        server.wait(15); deezer.wait(5); log.close()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+if __name__ == "__main__":
+    main()
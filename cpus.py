@@ -0,0 +1,19 @@
+"""
+CPUs this process may actually use, for sizing workers and pools. os.cpu_count() reports every
+core on the host; this honours the CPU affinity mask and a cgroup CPU quota (docker --cpus,
+Kubernetes CPU limits), rounded up.
+"""
+
+import math, os
+
+def available_cpus():
+    try: n = len(os.sched_getaffinity(0))
+    except AttributeError: n = os.cpu_count() or 1   # no affinity API (macOS, Windows)
+    try:
+        try: quota, period = open("/sys/fs/cgroup/cpu.max").read().split()             # cgroup v2
+        except FileNotFoundError:
+            quota, period = (open(f"/sys/fs/cgroup/cpu/cpu.cfs_{f}_us").read().strip()  # cgroup v1
+                             for f in ("quota", "period"))
+        if quota not in ("max", "-1"): n = min(n, max(1, math.ceil(int(quota)/int(period))))
+    except (OSError, ValueError): pass
+    return n
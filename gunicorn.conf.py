@@ -0,0 +1,36 @@
+"""
+gunicorn settings for SoundWave. Every value can be overridden from the environment.
+    gunicorn -c gunicorn.conf.py wsgi:app      (or just: python wsgi.py)
+"""
+
+import os, sys
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))  # for cpus.py, whatever the cwd
+from cpus import available_cpus
+
+bind = f"0.0.0.0:{os.environ.get('PORT', 5000)}"
+
+# One process per usable core (affinity and cgroup quota, not the host's count); requests mostly
+# wait on Deezer / yt-dlp, so each process runs a thread pool
+workers = int(os.environ.get("WEB_CONCURRENCY", available_cpus()))
+worker_class = "gthread"
+threads = int(os.environ.get("GUNICORN_THREADS", 16))
+
+# Downloads may take the full 300 s yt-dlp timeout; leave headroom before a worker is killed,
+# and let in-flight transcodes finish on reload/redeploy
+timeout = int(os.environ.get("GUNICORN_TIMEOUT", 330))
+graceful_timeout = int(os.environ.get("GUNICORN_GRACEFUL_TIMEOUT", 330))
+keepalive = int(os.environ.get("GUNICORN_KEEPALIVE", 5))
+
+# Import app.py (Flask, yt_dlp, caches) once in the master and share it copy-on-write. The import
+# starts no threads; each worker starts its own background threads right after the fork.
+preload_app = os.environ.get("GUNICORN_PRELOAD", "1") == "1"
+
+def post_fork(server, worker):
+    import app
+    app.start_background()
+
+# Recycle workers now and then to cap slow leaks (yt-dlp extractors, ffmpeg pipes)
+max_requests = int(os.environ.get("GUNICORN_MAX_REQUESTS", 2000))
+max_requests_jitter = int(os.environ.get("GUNICORN_MAX_REQUESTS_JITTER", 200))
+
+accesslog = os.environ.get("GUNICORN_ACCESS_LOG", "-")
@@ -0,0 +1,40 @@
+"""
+SoundWave Backend - production entry point
+Exposes the WSGI `app`; run directly to start the server picked by SERVER:
+    gunicorn (default)  multi-process, settings in gunicorn.conf.py
+    waitress            single process, WAITRESS_THREADS threads (no fork, e.g. on Windows)
+    uvicorn             the ASGI app in asgi.py, WEB_CONCURRENCY processes
+    dev                 Flask's development server
+"""
+
+import os, sys
+if os.environ.get("SERVER") in ("waitress", "dev"):  # one process, which app.py sizes its download lane for
+    os.environ.setdefault("WEB_CONCURRENCY", "1")
+from app import app, start_background
+from cpus import available_cpus
+
+def main():
+    server = os.environ.get("SERVER", "gunicorn")
+    port = int(os.environ.get("PORT", 5000))
+    workers = int(os.environ.get("WEB_CONCURRENCY", available_cpus()))
+    print(f"🎵 SoundWave on port {port} ({server})")
+    if server == "gunicorn":
+        from gunicorn.app.wsgiapp import WSGIApplication
+        conf = os.path.join(os.path.dirname(os.path.abspath(__file__)), "gunicorn.conf.py")
+        sys.argv = ["gunicorn", "-c", conf, "wsgi:app"]
+        WSGIApplication("%(prog)s [OPTIONS] [APP_MODULE]").run()
+    elif server == "waitress":
+        import waitress
+        start_background()
+        waitress.serve(app, host="0.0.0.0", port=port, threads=int(os.environ.get("WAITRESS_THREADS", 32)))
+    elif server == "uvicorn":
+        import uvicorn
+        uvicorn.run("asgi:app", host="0.0.0.0", port=port, workers=workers)
+    elif server == "dev":
+        start_background()
+        app.run(host="0.0.0.0",port=port,debug=False,threaded=True)
+    else:
+        sys.exit(f"Unknown SERVER={server!r}")
+
+if __name__ == "__main__":
+    main()